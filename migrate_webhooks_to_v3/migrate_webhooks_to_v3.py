@@ -4,18 +4,116 @@ import requests
 import argparse
 import sys
 import csv
+import copy
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds to wait for the API to accept a connection and to send a response
+DEFAULT_TIMEOUT = (10, 30)
+DEFAULT_RATE_LIMIT = 10
+
+
+class TokenBucket:
+    """Rate limiter shared between threads: allows `rate` requests per second
+    on average, with bursts of up to `rate` requests (at least one, so that
+    rates below one request per second still let requests through)
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a request may be made"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class WebhookRetry(Retry):
+    """Retries rate-limited (429) requests of any method, waiting as long as the
+    Retry-After header says, and transient server errors and read timeouts of
+    GET and DELETE requests. Other errors of POST requests aren't retried, since
+    the webhook may have been created anyway.
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == 'POST' and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        # The request may have been received already, so it isn't safe to
+        # retry POST requests after a read error
+        if error is not None and method is not None and \
+                method.upper() == 'POST' and self._is_read_error(error):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool,
+                                 _stacktrace)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP adapter that applies a default timeout to every request, and
+    optionally waits for a token from a shared rate limiter before sending
+    """
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, limiter=None, **kwargs):
+        self.timeout = timeout
+        self.limiter = limiter
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+def make_session(api_key, limiter=None, workers=1):
+    """Creates a keep-alive session for PagerDuty REST API requests, with
+    automatic retries and backoff, to be shared by all requests (and threads)
+    """
+    retry = WebhookRetry(
+        total=5,
+        connect=3,
+        read=3,
+        status=5,
+        backoff_factor=1,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'DELETE', 'POST']),
+        respect_retry_after_header=True,
+        # Return the last response once out of retries, so it can be reported
+        raise_on_status=False
+    )
+    session = requests.Session()
+    session.mount('https://', TimeoutHTTPAdapter(max_retries=retry, limiter=limiter,
+                                                 pool_maxsize=max(workers, 10)))
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Accept": "application/vnd.pagerduty+json;version=2",
+        "Authorization": f"Token token={api_key}"
+    })
+    return session
 
 
 class WebhookGetter:
-    def __init__(self, args):
+    def __init__(self, args, session=None):
         self.extension_url = f'https://api.pagerduty.com/extensions'
         self.subscription_url = f'https://api.pagerduty.com/webhook_subscriptions'
-        self.headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/vnd.pagerduty+json;version=2",
-            "Authorization": f"Token token={args.api_key}"
-        }
+        self.session = session if session is not None else make_session(args.api_key)
         self.csv_file = args.backup_file
         self.v1_extension_schema_id = 'PF9KMXH'
         self.v2_extension_schema_id = 'PJFWPEP'
@@ -53,7 +151,7 @@ class WebhookGetter:
                 writer.writerow([webhook_version, fields_to_be_mapped, full_webhook_object])
 
     def test_connection(self):
-        response = requests.get(self.extension_url + '?limit=1', headers=self.headers)
+        response = self.session.get(self.extension_url + '?limit=1')
         try:
             status = response.status_code
             json_response = response.json()
@@ -80,7 +178,7 @@ class WebhookGetter:
         v1_v2_webhooks = []
 
         while more:
-            response = requests.get(self.extension_url + f'?limit=100&offset={offset}', headers=self.headers).json()
+            response = self.session.get(self.extension_url + f'?limit=100&offset={offset}').json()
             if len(response['extensions']) == 0:
                 print('Found no webhooks to copy or delete')
             reduced_payload.extend(
@@ -109,7 +207,7 @@ class WebhookGetter:
         existing_v3_webhooks_map = {}
 
         while more:
-            response = requests.get(self.subscription_url + f'?limit=100&offset={offset}', headers=self.headers).json()
+            response = self.session.get(self.subscription_url + f'?limit=100&offset={offset}').json()
             v3_webhooks.extend(response.get('webhook_subscriptions', []))
             if not response['more']:
                 more = False
@@ -128,15 +226,14 @@ class WebhookGetter:
 
 
 class WebhookCreator:
-    def __init__(self, args, v1_v2_webhook_list, v3_webhooks_map):
+    def __init__(self, args, v1_v2_webhook_list, v3_webhooks_map, session=None):
         self.baseurl = f'https://api.pagerduty.com/webhook_subscriptions'
-        self.headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/vnd.pagerduty+json;version=2",
-            "Authorization": f"Token token={args.api_key}"
-        }
+        self.session = session if session is not None else make_session(args.api_key)
+        self.workers = getattr(args, 'workers', 1)
         self.v1_v2_webhooks = v1_v2_webhook_list
         self.existing_v3_webhooks = v3_webhooks_map
+        # Guards existing_v3_webhooks when creating webhooks concurrently
+        self.lock = threading.Lock()
         if args.event_types == 'all-new':
             self.v3_events = json.loads('''{"events": [
                     "incident.acknowledged",
@@ -180,8 +277,12 @@ class WebhookCreator:
         }''')
         self.v3_payload["webhook_subscription"]["events"] = self.v3_events["events"]
 
+    @staticmethod
+    def v3_webhook_key(webhook_params):
+        return webhook_params['url'] + webhook_params['filter_id'] + webhook_params['description']
+
     def v3_webhook_already_exists(self, webhook_params):
-        key = webhook_params['url'] + webhook_params['filter_id'] + webhook_params['description']
+        key = self.v3_webhook_key(webhook_params)
         if key in self.existing_v3_webhooks:
             print("WARNING: Not creating a new v3 webhook for\n"
                   f"    endpoint: {webhook_params['url']}\n"
@@ -191,51 +292,86 @@ class WebhookCreator:
             return True
         return False
 
+    def reserve_v3_webhook(self, webhook_params):
+        """Checks that a v3 webhook would not be a duplicate, and if so, records
+        it as existing before it is created, so that a concurrent create of an
+        identical webhook is skipped. Returns False if it would be a duplicate.
+        """
+        with self.lock:
+            if self.v3_webhook_already_exists(webhook_params):
+                return False
+            self.existing_v3_webhooks[self.v3_webhook_key(webhook_params)] = True
+            return True
+
+    def release_v3_webhook(self, webhook_params):
+        """Undoes reserve_v3_webhook after failing to create the webhook"""
+        with self.lock:
+            self.existing_v3_webhooks.pop(self.v3_webhook_key(webhook_params), None)
+
     def create_v3_webhook(self, webhook_params):
         """Constructs a v3 webhook payload"""
-        v3_webhook = self.v3_payload
+        v3_webhook = copy.deepcopy(self.v3_payload)
         v3_webhook['webhook_subscription']['delivery_method']['url'] = webhook_params['url']
         v3_webhook['webhook_subscription']['description'] = webhook_params['description']
         v3_webhook['webhook_subscription']['filter']['id'] = webhook_params['filter_id']
         return json.dumps(v3_webhook)
 
+    def create_webhook(self, webhook):
+        """Creates a v3 copy of one v1/v2 webhook, unless it would be a duplicate"""
+        if not self.reserve_v3_webhook(webhook):
+            return
+        data = self.create_v3_webhook(webhook)
+        try:
+            response = self.session.post(self.baseurl, data=data)
+        except requests.RequestException as e:
+            self.release_v3_webhook(webhook)
+            print(f"""ERROR: v3 copy of webhook {webhook['id']} ({webhook['description']}) on service
+            {webhook['filter_id']} was not created\n"""
+                  f"Request failed: {e}\n")
+            return
+        if 200 <= response.status_code < 300:
+            print(f"""Created a v3 copy of webhook {webhook['id']} ({webhook['description']})
+            on service {webhook['filter_id']}""")
+        else:
+            self.release_v3_webhook(webhook)
+            print(f"""ERROR: v3 copy of webhook {webhook['id']} ({webhook['description']}) on service
+            {webhook['filter_id']} was not created\n"""
+                  f"Received status code {response.status_code}\n")
+
     def create_webhooks(self):
-        """Creates v3 webhooks"""
-        for webhook in self.v1_v2_webhooks:
-            if self.v3_webhook_already_exists(webhook):
-                continue
-            data = self.create_v3_webhook(webhook)
-            response = requests.post(self.baseurl, headers=self.headers, data=data)
-            if 200 <= response.status_code < 300:
-                print(f"""Created a v3 copy of webhook {webhook['id']} ({webhook['description']})
-                on service {webhook['filter_id']}""")
-            else:
-                print(f"""ERROR: v3 copy of webhook {webhook['id']} ({webhook['description']}) on service
-                {webhook['filter_id']} was not created\n"""
-                      f"Received status code {response.status_code}\n")
+        """Creates v3 webhooks, on up to `workers` threads at once"""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self.create_webhook, self.v1_v2_webhooks))
 
 
 class WebhookDeleter:
-    def __init__(self, args, webhook_list):
+    def __init__(self, args, webhook_list, session=None):
         self.baseurl = f'https://api.pagerduty.com/extensions'
-        self.headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/vnd.pagerduty+json;version=2",
-            "Authorization": f"Token token={args.api_key}"
-        }
+        self.session = session if session is not None else make_session(args.api_key)
+        self.workers = getattr(args, 'workers', 1)
         self.webhooks = webhook_list
 
+    def delete_webhook(self, webhook):
+        """Deletes one v1/v2 webhook"""
+        try:
+            response = self.session.delete(self.baseurl + f"/{webhook['id']}")
+        except requests.RequestException as e:
+            print(f"""ERROR: a webhook with {webhook['id']} ({webhook['description']}) on service
+            {webhook['filter_id']} was not deleted\n"""
+                  f"Request failed: {e}\n")
+            return
+        if 200 <= response.status_code < 300:
+            print(f"""Deleted a webhook with {webhook['id']} ({webhook['description']})
+            on service {webhook['filter_id']}""")
+        else:
+            print(f"""ERROR: a webhook with {webhook['id']} ({webhook['description']}) on service
+            {webhook['filter_id']} was not deleted\n"""
+                  f"Received status code {response.status_code}\n")
+
     def delete_v1v2webhooks(self):
-        """Deletes v1/v2 webhooks"""
-        for webhook in self.webhooks:
-            response = requests.delete(self.baseurl + f"/{webhook['id']}", headers=self.headers)
-            if 200 <= response.status_code < 300:
-                print(f"""Deleted a webhook with {webhook['id']} ({webhook['description']})
-                on service {webhook['filter_id']}""")
-            else:
-                print(f"""ERROR: a webhook with {webhook['id']} ({webhook['description']}) on service
-                {webhook['filter_id']} was not deleted\n"""
-                      f"Received status code {response.status_code}\n")
+        """Deletes v1/v2 webhooks, on up to `workers` threads at once"""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self.delete_webhook, self.webhooks))
 
 
 def main():
@@ -267,16 +403,34 @@ def main():
                     default='copy',
                     choices=['copy', 'delete'],
                     help="action to take on v1/v2 webhooks en masse, 'copy' is default")
+    ap.add_argument('-w',
+                    '--workers',
+                    type=int,
+                    default=1,
+                    help="number of webhooks to create or delete at once, 1 is default")
+    ap.add_argument('-r',
+                    '--rate-limit',
+                    type=float,
+                    default=DEFAULT_RATE_LIMIT,
+                    help=f"maximum number of API requests per second across all workers, or 0 for no limit, "
+                         f"{DEFAULT_RATE_LIMIT} is default")
     args = ap.parse_args()
+    if args.workers < 1:
+        ap.error("--workers must be at least 1")
+    if args.rate_limit < 0:
+        ap.error("--rate-limit must not be negative")
+    limiter = TokenBucket(args.rate_limit) if args.rate_limit else None
+    session = make_session(args.api_key, limiter=limiter, workers=args.workers)
+    getter = WebhookGetter(args, session)
     if args.action == 'copy':
-        v1_v2_webhooks = WebhookGetter(args).get_v1v2_webhooks()
-        v3_webhooks = WebhookGetter(args).get_v3_webhooks()
-        WebhookGetter(args).write_json_to_csv(v1_v2_webhooks)
-        WebhookCreator(args, v1_v2_webhooks[1], v3_webhooks).create_webhooks()
+        v1_v2_webhooks = getter.get_v1v2_webhooks()
+        v3_webhooks = getter.get_v3_webhooks()
+        getter.write_json_to_csv(v1_v2_webhooks)
+        WebhookCreator(args, v1_v2_webhooks[1], v3_webhooks, session).create_webhooks()
     elif args.action == 'delete':
-        v1_v2_webhooks = WebhookGetter(args).get_v1v2_webhooks()
-        WebhookGetter(args).write_json_to_csv(v1_v2_webhooks)
-        WebhookDeleter(args, v1_v2_webhooks[1]).delete_v1v2webhooks()
+        v1_v2_webhooks = getter.get_v1v2_webhooks()
+        getter.write_json_to_csv(v1_v2_webhooks)
+        WebhookDeleter(args, v1_v2_webhooks[1], session).delete_v1v2webhooks()
 
 
 if __name__ == '__main__':
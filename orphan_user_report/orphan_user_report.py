@@ -33,199 +33,702 @@
 
 import argparse
 import csv
+import gzip
+import hashlib
 import json
 import logging
 import os
-from datetime import datetime
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 
 from pagerduty import RestApiV2Client
 
 log = logging.getLogger('orphan_users_report')
 
+DEFAULT_WORKERS = 8
+DEFAULT_RATE_LIMIT = 15
+# Listings in a snapshot are reused while their first page and total count are
+# unchanged, but fetched again in full at least this often
+DEFAULT_SNAPSHOT_TTL_HOURS = 30 * 24
+
+# Longest time range to request in a single query of incidents or log entries
+HISTORY_WINDOW_DAYS = 180
+
+
+class TokenBucket:
+    """
+    Rate limiter shared between threads: allows ``rate`` requests per second
+    on average, with bursts of up to ``capacity`` requests (at least one, so
+    that rates below one request per second still let requests through).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity or rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be made"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimitedClient(RestApiV2Client):
+    """REST API client that takes a token from a shared bucket per request"""
+
+    def __init__(self, api_key, limiter=None, **kw):
+        super().__init__(api_key, **kw)
+        self.limiter = limiter
+
+    def request(self, method, url, **kwargs):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return super().request(method, url, **kwargs)
+
+
+class SnapshotStore:
+    """
+    Persists fetched resources to a local SQLite database between runs.
+
+    Listings (users, schedules, escalation policies and services) are stored
+    with metadata summarizing them (see :meth:`PagerDutyCache._listing_metadata`)
+    and reused for as long as the metadata is unchanged, up to the TTL.
+    Schedule details are reused for as long as the schedule's entry in the
+    schedules listing is unchanged. Memberships found in each run are stored so
+    that orphans can be found with a SQL query.
+    """
+
+    # Tables from before listings had metadata are dropped and created anew
+    schema_version = 2
+
+    def __init__(self, path, ttl_hours=DEFAULT_SNAPSHOT_TTL_HOURS):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        # Resources may be fetched (and stored) from several threads at once
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        (version,) = self.db.execute('PRAGMA user_version').fetchone()
+        if version < self.schema_version:
+            self.db.executescript("""
+                DROP TABLE IF EXISTS listings;
+                DROP TABLE IF EXISTS schedule_details;
+            """)
+            self.db.execute('PRAGMA user_version = %d' % self.schema_version)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS listings (
+                name TEXT PRIMARY KEY, fetched_at REAL, metadata TEXT,
+                data TEXT);
+            CREATE TABLE IF NOT EXISTS schedule_details (
+                id TEXT PRIMARY KEY, fingerprint TEXT, data TEXT);
+            CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS memberships (
+                user_id TEXT, kind TEXT, PRIMARY KEY (user_id, kind));
+        """)
+
+    @staticmethod
+    def fingerprint(obj):
+        """Hash of a resource's listing entry, to tell whether it changed"""
+        return hashlib.sha1(
+            json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_listing(self, name, metadata):
+        """
+        Get a stored listing, or None if there is none within the TTL or its
+        metadata has changed since it was stored
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT fetched_at, metadata, data FROM listings WHERE name = ?',
+                (name,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl or \
+                row[1] != metadata:
+            return None
+        return json.loads(row[2])
+
+    def save_listing(self, name, items, metadata):
+        data = json.dumps(items)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)',
+                (name, time.time(), metadata, data))
+
+    def get_schedule_details(self, schedule):
+        """
+        Get the stored details of a schedule, or None if its listing entry
+        has changed since they were stored
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM schedule_details WHERE id = ? AND fingerprint = ?',
+                (schedule['id'], self.fingerprint(schedule))).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_schedule_details(self, schedules):
+        """Replace the stored details with those of the given schedules"""
+        rows = []
+        for schedule in schedules:
+            entry = {k: v for (k, v) in schedule.items() if k != 'details'}
+            rows.append((schedule['id'], self.fingerprint(entry),
+                         json.dumps(schedule['details'])))
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM schedule_details')
+            self.db.executemany(
+                'INSERT INTO schedule_details VALUES (?, ?, ?)', rows)
+
+    def save_memberships(self, user_ids, memberships):
+        """
+        Replace the stored users and memberships
+
+        :param user_ids: IDs of all users in the account
+        :param memberships: Dictionary mapping each kind of resource to the set
+            of IDs of users associated with a resource of that kind
+        """
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM users')
+            self.db.execute('DELETE FROM memberships')
+            self.db.executemany('INSERT OR REPLACE INTO users VALUES (?)',
+                                [(uid,) for uid in user_ids])
+            for (kind, member_ids) in memberships.items():
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO memberships VALUES (?, ?)',
+                    [(uid, kind) for uid in member_ids])
+
+    def find_orphan_user_ids(self):
+        """Get the IDs of stored users that have no stored memberships"""
+        with self.lock:
+            return {row[0] for row in self.db.execute(
+                'SELECT id FROM users EXCEPT SELECT user_id FROM memberships')}
+
+    def close(self):
+        self.db.close()
+
 
 class PagerDutyCache:
     """
     Caches all PagerDuty resources to minimize API calls.
-    Fetches users, schedules, escalation policies, teams, and open incidents once.
+    Fetches users (with their teams), schedules, escalation policies, and open
+    incidents once. If given a :class:`SnapshotStore`, resources stored in it
+    by a previous run are reused instead where possible.
     """
 
-    def __init__(self, access_token):
-        self.session = RestApiV2Client(access_token)
+    def __init__(self, access_token, workers=DEFAULT_WORKERS, snapshot=None,
+                 schedule_details=False, rate_limit=DEFAULT_RATE_LIMIT,
+                 activity_days=None):
+        limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.session = RateLimitedClient(access_token, limiter=limiter)
+        self.workers = workers
+        self.snapshot = snapshot
+        self.schedule_details = schedule_details
+        self.activity_days = activity_days
         self._users = None
         self._schedules = None
         self._escalation_policies = None
-        self._teams = None
-        self._team_users = {}
-        self._open_incidents = None
+        self._services = None
+        self._open_incident_count = None
         self._user_incident_counts = {}
+        self._user_activity = None
+
+    def prefetch(self, services=False):
+        """
+        Fetch users, schedules, escalation policies, open incidents and
+        (optionally) services and user activity all at once, since none depends
+        on another. All requests share the client's rate limiter.
+
+        Progress is printed from the calling thread as each fetch completes;
+        the fetches themselves only log it, so lines are never interleaved.
+        """
+        fetches = [(self.get_users, 'users'),
+                   (self.get_schedules, 'schedules'),
+                   (self.get_escalation_policies, 'escalation policies'),
+                   (self.count_open_incidents, 'open incidents')]
+        if services:
+            fetches.append((self.get_services, 'services'))
+        if self.activity_days:
+            fetches.append((self.get_user_activity,
+                            'log entries of the last %d days' % self.activity_days))
+        labels = [label for (fetch, label) in fetches]
+        if self.schedule_details or self.activity_days:
+            wait = 'several minutes'
+        else:
+            wait = 'a moment'
+        print("Fetching %s and %s. This may take %s..." % (
+            ', '.join(labels[:-1]), labels[-1], wait))
+        with ThreadPoolExecutor(max_workers=len(fetches)) as executor:
+            futures = {executor.submit(fetch): label
+                       for (fetch, label) in fetches}
+            for future in as_completed(futures):
+                # Raise the first error, if any
+                future.result()
+                print("Fetched %s" % futures[future])
 
     def get_users(self):
-        """Fetch and cache all users"""
+        """Fetch and cache all users, including the teams they belong to"""
         if self._users is None:
             log.info("Fetching all users...")
-            print("Fetching all users. This may take a moment...")
-            self._users = self.session.list_all('users')
+            users = self._list_all('users', params={'include[]': ['teams']})
+            # Offset pagination can return a user twice if the listing shifts
+            # between pages; keep each user's first entry only
+            seen = set()
+            self._users = []
+            for user in users:
+                if user['id'] not in seen:
+                    seen.add(user['id'])
+                    self._users.append(user)
             log.info("Found %d users", len(self._users))
         return self._users
 
     def get_schedules(self):
-        """Fetch and cache all schedules with their user details"""
+        """
+        Fetch and cache all schedules. Each schedule's details (including its
+        layers) are only fetched if ``schedule_details`` is set.
+        """
         if self._schedules is None:
             log.info("Fetching all schedules...")
-            print("Fetching all schedules. This may take several minutes...")
-            self._schedules = self.session.list_all('schedules')
-            for schedule in self._schedules:
-                schedule['details'] = self.session.rget(schedule.get('self'))
+            self._schedules = self._list_all('schedules')
+            if self.schedule_details:
+                self._fetch_schedule_details(self._schedules)
             log.info("Found %d schedules", len(self._schedules))
         return self._schedules
 
+    def _list_all(self, resource, params=None):
+        """
+        List all of a resource, or get the listing from the snapshot if its
+        metadata is unchanged and it was stored within the TTL
+        """
+        if self.snapshot is None:
+            return self.session.list_all(resource, params=params)
+        metadata = self._listing_metadata(resource, params)
+        items = self.snapshot.get_listing(resource, metadata)
+        if items is not None:
+            log.info("Using %s from snapshot %s", resource, self.snapshot.path)
+        else:
+            items = self.session.list_all(resource, params=params)
+            self.snapshot.save_listing(resource, items, metadata)
+        return items
+
+    def _listing_metadata(self, resource, params=None):
+        """
+        Summarize a listing with a single request: a hash of its total count
+        and its first page. Adding or removing any item, or changing one on
+        the first page, changes the summary.
+        """
+        query = dict(params or {}, total=True, offset=0)
+        body = self.session.jget(resource, params=query)
+        return SnapshotStore.fingerprint(
+            {'total': body.get('total'), 'items': body.get(resource)})
+
+    def _fetch_schedule_details(self, schedules):
+        """
+        Fetch each schedule's details concurrently, on up to ``self.workers``
+        threads. The client retries rate-limited (429) requests with backoff.
+        """
+        to_fetch = schedules
+        if self.snapshot is not None:
+            to_fetch = []
+            for schedule in schedules:
+                details = self.snapshot.get_schedule_details(schedule)
+                if details is None:
+                    to_fetch.append(schedule)
+                else:
+                    schedule['details'] = details
+            log.info("Using details of %d unchanged schedules from snapshot",
+                     len(schedules) - len(to_fetch))
+        total = len(to_fetch)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.session.rget, s.get('self')): s
+                       for s in to_fetch}
+            for (done, future) in enumerate(as_completed(futures), 1):
+                futures[future]['details'] = future.result()
+                if done % 50 == 0 or done == total:
+                    log.info("Fetched details of %d/%d schedules", done, total)
+        if self.snapshot is not None:
+            self.snapshot.save_schedule_details(schedules)
+
     def get_escalation_policies(self):
         """Fetch and cache all escalation policies"""
         if self._escalation_policies is None:
             log.info("Fetching all escalation policies...")
-            print("Fetching all escalation policies. This may take a moment...")
-            self._escalation_policies = self.session.list_all('escalation_policies')
+            self._escalation_policies = self._list_all('escalation_policies')
             log.info("Found %d escalation policies", len(self._escalation_policies))
         return self._escalation_policies
 
-    def get_teams(self):
-        """Fetch and cache all teams"""
-        if self._teams is None:
-            log.info("Fetching all teams...")
-            print("Fetching all teams. This may take a moment...")
-            self._teams = self.session.list_all('teams')
-            log.info("Found %d teams", len(self._teams))
-        return self._teams
-
-    def get_team_users(self, team_id):
-        """Fetch and cache users for a specific team"""
-        if team_id not in self._team_users:
-            users = self.session.list_all('users', params={'team_ids[]': team_id})
-            self._team_users[team_id] = [u['id'] for u in users]
-        return self._team_users[team_id]
-
-    def get_open_incidents(self):
-        """Fetch and cache all open (triggered/acknowledged) incidents"""
-        if self._open_incidents is None:
-            log.info("Fetching open incidents (max 9,999)...")
-            print("Fetching open incidents (max 9,999). This may take a moment...")
-            incident_limit = 9999
-            incident_count = 0
-            self._open_incidents = []
-            for incident in self.session.iter_all(
-                'incidents',
-                params={
-                    'statuses[]': ['triggered', 'acknowledged'],
-                    'date_range': 'all'
-                }
-            ):
-                self._open_incidents.append(incident)
-                incident_count += 1
-                if incident_count >= incident_limit:
-                    log.info("Reached incident limit of %d", incident_limit)
-                    break
-            log.info("Found %d open incidents", len(self._open_incidents))
-            self._build_user_incident_counts()
-        return self._open_incidents
-
-    def _build_user_incident_counts(self):
-        """Build a mapping of user IDs to their open incident counts"""
-        for incident in self._open_incidents:
-            for assignment in incident.get('assignments', []):
-                assignee = assignment.get('assignee', {})
-                if assignee.get('type') in ('user', 'user_reference'):
-                    user_id = assignee.get('id')
-                    self._user_incident_counts[user_id] = \
-                        self._user_incident_counts.get(user_id, 0) + 1
+    def get_services(self):
+        """Fetch and cache all services"""
+        if self._services is None:
+            log.info("Fetching all services...")
+            self._services = self._list_all('services')
+            log.info("Found %d services", len(self._services))
+        return self._services
+
+    def count_open_incidents(self):
+        """
+        Count open (triggered/acknowledged) incidents per assignee.
+
+        Incidents are counted as they are fetched rather than cached. The query
+        is split into date windows (see :meth:`_iter_open_incidents`) so that
+        there is no cap on the number of incidents counted.
+        """
+        if self._open_incident_count is None:
+            log.info("Fetching open incidents...")
+            self._open_incident_count = 0
+            # Windows may overlap at their boundaries:
+            seen_ids = set()
+            for incident in self._iter_open_incidents():
+                if incident['id'] in seen_ids:
+                    continue
+                seen_ids.add(incident['id'])
+                self._open_incident_count += 1
+                self._count_incident_assignees(incident)
+            log.info("Found %d open incidents", self._open_incident_count)
+        return self._open_incident_count
+
+    def _iter_open_incidents(self):
+        """
+        Iterate over all open incidents, from the oldest one until now.
+
+        See :meth:`_iter_history_windows` for how the query is split up.
+        """
+        params = {'statuses[]': ['triggered', 'acknowledged']}
+        oldest = self.session.rget('incidents', params=dict(
+            params, date_range='all', sort_by='created_at:asc', limit=1))
+        if not oldest:
+            return
+        since = datetime.fromisoformat(
+            oldest[0]['created_at'].replace('Z', '+00:00'))
+        since -= timedelta(seconds=1)
+        for incident in self._iter_history_windows('incidents', since, params):
+            yield incident
+
+    def _iter_history_windows(self, resource, since, params=None):
+        """
+        Iterate over a historical resource (incidents or log entries) created
+        from a given time until now.
+
+        Each window of up to HISTORY_WINDOW_DAYS is fetched with
+        ``iter_history``, which bisects the window further if it contains more
+        results than can be paginated through in a single query. Results on
+        the boundary of two windows may be yielded twice.
+        """
+        now = datetime.now(timezone.utc) + timedelta(minutes=1)
+        while since < now:
+            until = min(since + timedelta(days=HISTORY_WINDOW_DAYS), now)
+            log.info("Fetching %s created between %s and %s", resource,
+                     since.isoformat(), until.isoformat())
+            for item in self.session.iter_history(
+                    resource, since, until, params=dict(params or {})):
+                yield item
+            since = until
+
+    def get_user_activity(self):
+        """
+        Find each user's latest notification and incident assignment within
+        the last ``activity_days`` days, from the log entries in that window.
+
+        Only the latest timestamp of each kind is kept per user.
+
+        :returns: Dictionary mapping user IDs to dictionaries with the keys
+            ``last_notified_at`` and ``last_assigned_at``
+        """
+        if self._user_activity is None:
+            log.info("Fetching log entries of the last %d days...",
+                     self.activity_days)
+            activity = {}
+            since = datetime.now(timezone.utc) - timedelta(
+                days=self.activity_days)
+            for entry in self._iter_history_windows('log_entries', since):
+                if entry.get('type') == 'notify_log_entry':
+                    key = 'last_notified_at'
+                    user_ids = [(entry.get('user') or {}).get('id')]
+                elif entry.get('type') == 'assign_log_entry':
+                    key = 'last_assigned_at'
+                    user_ids = [a.get('id') for a in entry.get('assignees', [])
+                                if a.get('type') in ('user', 'user_reference')]
+                else:
+                    continue
+                created_at = entry.get('created_at')
+                for user_id in user_ids:
+                    if user_id is None:
+                        continue
+                    user_activity = activity.setdefault(user_id, {
+                        'last_notified_at': None, 'last_assigned_at': None})
+                    # Timestamps are all in the same ISO 8601 format:
+                    latest = user_activity[key]
+                    if latest is None or latest < created_at:
+                        user_activity[key] = created_at
+            self._user_activity = activity
+            log.info("Found activity for %d users", len(activity))
+        return self._user_activity
+
+    def get_last_activity(self, user_id):
+        """
+        Get a user's latest notification and assignment times, or None for
+        each if there were none in the window or activity isn't being checked
+        """
+        if not self.activity_days:
+            return {'last_notified_at': None, 'last_assigned_at': None}
+        return self.get_user_activity().get(
+            user_id, {'last_notified_at': None, 'last_assigned_at': None})
+
+    def _count_incident_assignees(self, incident):
+        """Add an incident to the open incident counts of its assignees"""
+        for assignment in incident.get('assignments', []):
+            assignee = assignment.get('assignee', {})
+            if assignee.get('type') in ('user', 'user_reference'):
+                user_id = assignee.get('id')
+                self._user_incident_counts[user_id] = \
+                    self._user_incident_counts.get(user_id, 0) + 1
 
     def get_user_incident_count(self, user_id):
         """Get the number of open incidents for a specific user"""
-        self.get_open_incidents()
+        self.count_open_incidents()
         return self._user_incident_counts.get(user_id, 0)
 
     def get_users_with_open_incidents(self):
         """Get set of user IDs that have open incidents"""
-        self.get_open_incidents()
+        self.count_open_incidents()
         return set(self._user_incident_counts.keys())
 
 
+class MembershipIndex:
+    """
+    Records which users are associated with each kind of resource, as one
+    bitset per kind over dense user ordinals (the users' positions in the list
+    of all users, counting each ID once).
+
+    Each kind of association costs one bit per user. The mapping of user IDs
+    to ordinals is kept as a dict, so the index as a whole still takes memory
+    in proportion to the number of user IDs.
+    """
+
+    def __init__(self, user_ids):
+        self.ordinals = {}
+        for uid in user_ids:
+            self.ordinals.setdefault(uid, len(self.ordinals))
+        self.user_ids = list(self.ordinals)
+        self.nbytes = (len(self.user_ids) + 7) // 8
+        self.bits = {}
+
+    def clear(self, kind):
+        """Start (or restart) recording associations of a kind"""
+        self.bits[kind] = bytearray(self.nbytes)
+
+    def add(self, kind, user_id):
+        """
+        Record that a user is associated with a kind of resource. IDs of users
+        that are not in the account (i.e. deleted users) are ignored.
+        """
+        i = self.ordinals.get(user_id)
+        if i is not None:
+            self.bits[kind][i >> 3] |= 1 << (i & 7)
+
+    def contains(self, kind, ordinal):
+        return bool(self.bits[kind][ordinal >> 3] >> (ordinal & 7) & 1)
+
+    def mask(self, kind):
+        return int.from_bytes(self.bits[kind], 'little')
+
+    def count(self, kind):
+        return bin(self.mask(kind)).count('1')
+
+    def member_ids(self, kind):
+        """Yield the IDs of users associated with a kind of resource"""
+        for (i, uid) in enumerate(self.user_ids):
+            if self.contains(kind, i):
+                yield uid
+
+    def none_of(self, kinds):
+        """
+        Get a bitset (as bytes, indexed like the others) of users that are not
+        associated with any of the given kinds of resources
+        """
+        associated = 0
+        for kind in kinds:
+            associated |= self.mask(kind)
+        everyone = (1 << len(self.user_ids)) - 1
+        return (everyone & ~associated).to_bytes(self.nbytes, 'little')
+
+
 class OrphanUsersFinder:
     """
     Finds users not associated with any schedules, escalation policies, or teams.
     Also tracks open incidents assigned to users.
     """
 
+    # Kinds of association that keep a user from being an orphan
+    ASSOCIATIONS = ('schedule', 'escalation_policy', 'team')
+
     def __init__(self, cache):
         self.cache = cache
-        self.users_in_schedules = set()
-        self.users_in_escalation_policies = set()
-        self.users_in_teams = set()
-        self.users_with_incidents = set()
+        self._index = None
+
+    @property
+    def index(self):
+        """The :class:`MembershipIndex` of all users in the account"""
+        if self._index is None:
+            self._index = MembershipIndex(u['id'] for u in self.cache.get_users())
+        return self._index
 
     def extract_users_from_schedules(self):
         """Extract all user IDs from all schedules"""
         log.info("Extracting users from schedules...")
+        index = self.index
+        index.clear('schedule')
         schedules = self.cache.get_schedules()
         for schedule in schedules:
-            details = schedule.get('details', {})
-            for user in details.get('users', []):
-                self.users_in_schedules.add(user.get('id'))
-            for layer in details.get('schedule_layers', []):
-                for user_entry in layer.get('users', []):
-                    user = user_entry.get('user', {})
-                    self.users_in_schedules.add(user.get('id'))
-        log.info("Found %d users in schedules", len(self.users_in_schedules))
+            for user_id in self._schedule_user_ids(schedule):
+                index.add('schedule', user_id)
+        log.info("Found %d users in schedules", index.count('schedule'))
+
+    @staticmethod
+    def _schedule_user_ids(schedule):
+        """Yield the IDs of the users on a schedule"""
+        if 'details' not in schedule:
+            # The listing includes the users of each schedule
+            for user in schedule.get('users', []):
+                yield user.get('id')
+            return
+        details = schedule['details']
+        for user in details.get('users', []):
+            yield user.get('id')
+        for layer in details.get('schedule_layers', []):
+            for user_entry in layer.get('users', []):
+                yield user_entry.get('user', {}).get('id')
 
     def extract_users_from_escalation_policies(self):
         """Extract all user IDs from all escalation policies"""
         log.info("Extracting users from escalation policies...")
+        index = self.index
+        index.clear('escalation_policy')
         policies = self.cache.get_escalation_policies()
         for policy in policies:
             for rule in policy.get('escalation_rules', []):
                 for target in rule.get('targets', []):
                     if target.get('type') in ('user', 'user_reference'):
-                        self.users_in_escalation_policies.add(target.get('id'))
-        log.info("Found %d users in escalation policies", len(self.users_in_escalation_policies))
+                        index.add('escalation_policy', target.get('id'))
+        log.info("Found %d users in escalation policies",
+                 index.count('escalation_policy'))
 
     def extract_users_from_teams(self):
-        """Extract all user IDs from all teams"""
+        """Extract all user IDs that are members of any team"""
         log.info("Extracting users from teams...")
-        teams = self.cache.get_teams()
-        for team in teams:
-            team_user_ids = self.cache.get_team_users(team['id'])
-            self.users_in_teams.update(team_user_ids)
-        log.info("Found %d users in teams", len(self.users_in_teams))
+        index = self.index
+        index.clear('team')
+        for user in self.cache.get_users():
+            if user.get('teams'):
+                index.add('team', user['id'])
+        log.info("Found %d users in teams", index.count('team'))
 
     def extract_users_with_open_incidents(self):
         """Extract all user IDs that have open incidents assigned"""
         log.info("Extracting users with open incidents...")
-        self.users_with_incidents = self.cache.get_users_with_open_incidents()
-        log.info("Found %d users with open incidents", len(self.users_with_incidents))
+        index = self.index
+        index.clear('incident')
+        for user_id in self.cache.get_users_with_open_incidents():
+            index.add('incident', user_id)
+        log.info("Found %d users with open incidents", index.count('incident'))
 
-    def find_orphan_users(self):
-        """Find users not in any schedule, escalation policy, or team"""
+    def extract_reachable_users(self):
+        """
+        Extract all user IDs that can be paged by some service, i.e. that are
+        reached by following services to their escalation policies, and
+        escalation policies to their target users and schedules.
+
+        Each escalation policy and schedule is visited at most once, in a
+        breadth-first traversal starting from all enabled services.
+        """
+        log.info("Extracting users reachable from services...")
+        index = self.index
+        index.clear('reachable')
+        policy_targets = {
+            policy['id']: [target for rule in policy.get('escalation_rules', [])
+                           for target in rule.get('targets', [])]
+            for policy in self.cache.get_escalation_policies()
+        }
+        schedules = {s['id']: s for s in self.cache.get_schedules()}
+
+        queue = deque()
+        visited = set()
+        for service in self.cache.get_services():
+            policy = service.get('escalation_policy') or {}
+            node = ('escalation_policy', policy.get('id'))
+            if service.get('status') != 'disabled' and node not in visited:
+                visited.add(node)
+                queue.append(node)
+        while queue:
+            (kind, obj_id) = queue.popleft()
+            if kind == 'schedule':
+                if obj_id in schedules:
+                    for user_id in self._schedule_user_ids(schedules[obj_id]):
+                        index.add('reachable', user_id)
+                continue
+            for target in policy_targets.get(obj_id, []):
+                if target.get('type') in ('user', 'user_reference'):
+                    index.add('reachable', target.get('id'))
+                elif target.get('type') in ('schedule', 'schedule_reference'):
+                    node = ('schedule', target.get('id'))
+                    if node not in visited:
+                        visited.add(node)
+                        queue.append(node)
+        log.info("Found %d users reachable from services",
+                 index.count('reachable'))
+
+    def _find_orphans(self):
+        """
+        Get a bitset (as bytes, indexed like the :class:`MembershipIndex`) of
+        users without any of the associations in :attr:`ASSOCIATIONS`. With a
+        snapshot, memberships are stored and orphans are found with SQL.
+        """
+        index = self.index
+        if self.cache.snapshot is None:
+            return index.none_of(self.ASSOCIATIONS)
+        self.cache.snapshot.save_memberships(index.user_ids, {
+            kind: index.member_ids(kind) for kind in self.ASSOCIATIONS
+        })
+        orphans = bytearray(index.nbytes)
+        for user_id in self.cache.snapshot.find_orphan_user_ids():
+            i = index.ordinals[user_id]
+            orphans[i >> 3] |= 1 << (i & 7)
+        return bytes(orphans)
+
+    def iter_orphan_users(self):
+        """
+        Yield report rows of users not in any schedule, escalation policy, or
+        team, as they are computed
+        """
+        self.cache.prefetch()
         self.extract_users_from_schedules()
         self.extract_users_from_escalation_policies()
         self.extract_users_from_teams()
         self.extract_users_with_open_incidents()
 
         all_users = self.cache.get_users()
-        all_user_ids = {u['id'] for u in all_users}
-
-        associated_users = (
-            self.users_in_schedules |
-            self.users_in_escalation_policies |
-            self.users_in_teams
-        )
+        orphans = self._find_orphans()
 
-        orphan_user_ids = all_user_ids - associated_users
-
-        orphan_users = []
-        for user in all_users:
-            if user['id'] in orphan_user_ids:
+        n_orphans = 0
+        for (i, user) in enumerate(all_users):
+            if orphans[i >> 3] >> (i & 7) & 1:
+                n_orphans += 1
                 user_id = user['id']
                 open_incident_count = self.cache.get_user_incident_count(user_id)
-                orphan_users.append({
+                activity = self.cache.get_last_activity(user_id)
+                yield {
                     'id': user_id,
                     'name': user.get('name'),
                     'email': user.get('email'),
@@ -236,120 +739,116 @@ class OrphanUsersFinder:
                     'in_escalation_policies': False,
                     'in_teams': False,
                     'has_open_incidents': open_incident_count > 0,
-                    'open_incident_count': open_incident_count
-                })
+                    'open_incident_count': open_incident_count,
+                    'is_orphan': True,
+                    'is_reachable': False,
+                    'last_notified_at': activity['last_notified_at'],
+                    'last_assigned_at': activity['last_assigned_at']
+                }
 
         log.info("Found %d orphan users out of %d total users",
-                 len(orphan_users), len(all_users))
-        return orphan_users
+                 n_orphans, len(all_users))
 
-    def find_partially_orphaned_users(self):
+    def find_orphan_users(self):
+        """Find users not in any schedule, escalation policy, or team"""
+        return list(self.iter_orphan_users())
+
+    def iter_user_report(self):
         """
-        Find users with detailed association info.
-        Returns all users with flags indicating their associations.
+        Yield report rows of all users, with flags indicating their
+        associations, as they are computed
         """
+        self.cache.prefetch(services=True)
         self.extract_users_from_schedules()
         self.extract_users_from_escalation_policies()
         self.extract_users_from_teams()
         self.extract_users_with_open_incidents()
+        self.extract_reachable_users()
 
-        all_users = self.cache.get_users()
-        user_report = []
-
-        for user in all_users:
+        index = self.index
+        orphans = self._find_orphans()
+        for (i, user) in enumerate(self.cache.get_users()):
             uid = user['id']
-            in_schedules = uid in self.users_in_schedules
-            in_eps = uid in self.users_in_escalation_policies
-            in_teams = uid in self.users_in_teams
             open_incident_count = self.cache.get_user_incident_count(uid)
+            activity = self.cache.get_last_activity(uid)
 
-            user_report.append({
+            yield {
                 'id': uid,
                 'name': user.get('name'),
                 'email': user.get('email'),
                 'role': user.get('role'),
                 'job_title': user.get('job_title', ''),
                 'time_zone': user.get('time_zone', ''),
-                'in_schedules': in_schedules,
-                'in_escalation_policies': in_eps,
-                'in_teams': in_teams,
+                'in_schedules': index.contains('schedule', i),
+                'in_escalation_policies': index.contains('escalation_policy', i),
+                'in_teams': index.contains('team', i),
                 'has_open_incidents': open_incident_count > 0,
                 'open_incident_count': open_incident_count,
-                'is_orphan': not (in_schedules or in_eps or in_teams)
-            })
-
-        return user_report
-
-
-class ReportGenerator:
-    """Generates reports in various formats"""
+                'is_orphan': bool(orphans[i >> 3] >> (i & 7) & 1),
+                'is_reachable': index.contains('reachable', i),
+                'last_notified_at': activity['last_notified_at'],
+                'last_assigned_at': activity['last_assigned_at']
+            }
 
-    def __init__(self, output_dir='reports'):
-        self.output_dir = output_dir
-        if not os.path.isdir(output_dir):
-            os.mkdir(output_dir)
-
-    def generate_csv_report(self, users, filename=None):
-        """Generate a CSV report of users"""
-        if filename is None:
-            filename = 'orphan_users_%s.csv' % datetime.now().strftime('%Y%m%d_%H%M%S')
-        filepath = os.path.join(self.output_dir, filename)
+    def find_partially_orphaned_users(self):
+        """
+        Find users with detailed association info.
+        Returns all users with flags indicating their associations.
+        """
+        return list(self.iter_user_report())
 
-        fieldnames = [
-            'id', 'name', 'email', 'role', 'job_title', 'time_zone',
-            'in_schedules', 'in_escalation_policies', 'in_teams',
-            'has_open_incidents', 'open_incident_count', 'is_orphan'
-        ]
 
-        with open(filepath, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for user in users:
-                writer.writerow(user)
+REPORT_FIELDS = [
+    'id', 'name', 'email', 'role', 'job_title', 'time_zone',
+    'in_schedules', 'in_escalation_policies', 'in_teams',
+    'has_open_incidents', 'open_incident_count', 'is_orphan', 'is_reachable',
+    'last_notified_at', 'last_assigned_at'
+]
 
-        log.info("CSV report saved to %s", filepath)
-        print("CSV report saved to: %s" % filepath)
-        return filepath
 
-    def generate_json_report(self, users, filename=None):
-        """Generate a JSON report of users"""
-        if filename is None:
-            filename = 'orphan_users_%s.json' % datetime.now().strftime('%Y%m%d_%H%M%S')
-        filepath = os.path.join(self.output_dir, filename)
+class ReportSummary:
+    """
+    Accumulates the console summary one user at a time, keeping only the
+    orphan users (which are listed individually)
+    """
 
-        with open(filepath, 'w') as jsonfile:
-            json.dump({
-                'generated_at': datetime.now().isoformat(),
-                'total_users': len(users),
-                'orphan_count': sum(1 for u in users if u.get('is_orphan', True)),
-                'users': users
-            }, jsonfile, indent=2)
+    def __init__(self):
+        self.total = 0
+        self.in_schedules = 0
+        self.in_eps = 0
+        self.in_teams = 0
+        self.with_incidents = 0
+        self.total_incidents = 0
+        self.unreachable = 0
+        self.orphans = []
 
-        log.info("JSON report saved to %s", filepath)
-        print("JSON report saved to: %s" % filepath)
-        return filepath
+    def add(self, user):
+        self.total += 1
+        self.in_schedules += bool(user.get('in_schedules'))
+        self.in_eps += bool(user.get('in_escalation_policies'))
+        self.in_teams += bool(user.get('in_teams'))
+        self.with_incidents += bool(user.get('has_open_incidents'))
+        self.total_incidents += user.get('open_incident_count', 0)
+        self.unreachable += not user.get('is_reachable', False)
+        if user.get('is_orphan', True):
+            self.orphans.append(user)
 
-    def print_summary(self, users):
+    def print_summary(self):
         """Print a summary to console"""
-        total = len(users)
-        orphans = [u for u in users if u.get('is_orphan', True)]
-        in_schedules = sum(1 for u in users if u.get('in_schedules'))
-        in_eps = sum(1 for u in users if u.get('in_escalation_policies'))
-        in_teams = sum(1 for u in users if u.get('in_teams'))
-        with_incidents = sum(1 for u in users if u.get('has_open_incidents'))
-        total_incidents = sum(u.get('open_incident_count', 0) for u in users)
+        orphans = self.orphans
         orphans_with_incidents = [u for u in orphans if u.get('has_open_incidents')]
 
         print("\n" + "=" * 60)
         print("PAGERDUTY USER ASSOCIATION REPORT")
         print("=" * 60)
-        print("Total Users:                    %d" % total)
-        print("Users in Schedules:             %d" % in_schedules)
-        print("Users in Escalation Policies:   %d" % in_eps)
-        print("Users in Teams:                 %d" % in_teams)
+        print("Total Users:                    %d" % self.total)
+        print("Users in Schedules:             %d" % self.in_schedules)
+        print("Users in Escalation Policies:   %d" % self.in_eps)
+        print("Users in Teams:                 %d" % self.in_teams)
+        print("Unreachable Users:              %d" % self.unreachable)
         print("-" * 60)
-        print("Users with Open Incidents:      %d" % with_incidents)
-        print("Total Open Incidents:           %d" % total_incidents)
+        print("Users with Open Incidents:      %d" % self.with_incidents)
+        print("Total Open Incidents:           %d" % self.total_incidents)
         print("-" * 60)
         print("Orphan Users (no associations): %d" % len(orphans))
         print("Orphans with Open Incidents:    %d" % len(orphans_with_incidents))
@@ -373,6 +872,156 @@ class ReportGenerator:
         print("")
 
 
+class ReportWriter:
+    """
+    Writes users to a report file one at a time, so that the whole report
+    never needs to be held in memory
+    """
+
+    label = 'Report'
+
+    def __init__(self, filepath, fileobj):
+        self.filepath = filepath
+        self.file = fileobj
+        self.count = 0
+        self.orphan_count = 0
+
+    def write(self, user):
+        self.count += 1
+        self.orphan_count += bool(user.get('is_orphan', True))
+
+    def close(self):
+        self.file.close()
+        log.info("%s saved to %s", self.label, self.filepath)
+        print("%s saved to: %s" % (self.label, self.filepath))
+        return self.filepath
+
+    def discard(self):
+        """Close and delete an incomplete report"""
+        self.file.close()
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+        log.warning("Incomplete %s removed: %s", self.label, self.filepath)
+
+
+class CsvReportWriter(ReportWriter):
+    """Writes a CSV report, one row per user"""
+
+    label = 'CSV report'
+
+    def __init__(self, filepath, fileobj):
+        super().__init__(filepath, fileobj)
+        self.writer = csv.DictWriter(self.file, fieldnames=REPORT_FIELDS)
+        self.writer.writeheader()
+
+    def write(self, user):
+        super().write(user)
+        self.writer.writerow(user)
+
+
+class NdjsonReportWriter(ReportWriter):
+    """Writes a newline-delimited JSON report, one object per user"""
+
+    label = 'NDJSON report'
+
+    def write(self, user):
+        super().write(user)
+        self.file.write(json.dumps(user) + '\n')
+
+
+class JsonReportWriter(ReportWriter):
+    """
+    Writes a JSON report document. The totals are written after the list of
+    users, once they are known.
+    """
+
+    label = 'JSON report'
+
+    def __init__(self, filepath, fileobj):
+        super().__init__(filepath, fileobj)
+        self.file.write('{\n  "generated_at": %s,\n  "users": [' %
+                        json.dumps(datetime.now().isoformat()))
+
+    def write(self, user):
+        if self.count:
+            self.file.write(',')
+        self.file.write('\n    ' + json.dumps(user))
+        super().write(user)
+
+    def close(self):
+        self.file.write('\n  ],\n  "total_users": %d,\n  "orphan_count": %d\n}\n'
+                        % (self.count, self.orphan_count))
+        return super().close()
+
+
+class ReportGenerator:
+    """Generates reports in various formats"""
+
+    def __init__(self, output_dir='reports', compress=False):
+        self.output_dir = output_dir
+        self.compress = compress
+        if not os.path.isdir(output_dir):
+            os.mkdir(output_dir)
+
+    def open_writer(self, writer_class, extension, filename=None):
+        """
+        Open a report file for writing users to one at a time, gzipped if
+        compression is enabled
+
+        :param writer_class: Subclass of :class:`ReportWriter` to use
+        :param extension: File name extension for the report format
+        :param filename: Name of the file in the output directory
+        """
+        if filename is None:
+            filename = 'orphan_users_%s.%s' % (
+                datetime.now().strftime('%Y%m%d_%H%M%S'), extension)
+        if self.compress and not filename.endswith('.gz'):
+            filename += '.gz'
+        filepath = os.path.join(self.output_dir, filename)
+        if self.compress:
+            fileobj = gzip.open(filepath, 'wt', newline='')
+        else:
+            fileobj = open(filepath, 'w', newline='')
+        return writer_class(filepath, fileobj)
+
+    def csv_writer(self, filename=None):
+        return self.open_writer(CsvReportWriter, 'csv', filename)
+
+    def ndjson_writer(self, filename=None):
+        return self.open_writer(NdjsonReportWriter, 'ndjson', filename)
+
+    def json_writer(self, filename=None):
+        return self.open_writer(JsonReportWriter, 'json', filename)
+
+    def _generate_report(self, writer, users):
+        try:
+            for user in users:
+                writer.write(user)
+        except BaseException:
+            writer.discard()
+            raise
+        return writer.close()
+
+    def generate_csv_report(self, users, filename=None):
+        """Generate a CSV report of users"""
+        return self._generate_report(self.csv_writer(filename), users)
+
+    def generate_ndjson_report(self, users, filename=None):
+        """Generate a newline-delimited JSON report of users"""
+        return self._generate_report(self.ndjson_writer(filename), users)
+
+    def generate_json_report(self, users, filename=None):
+        """Generate a JSON report of users"""
+        return self._generate_report(self.json_writer(filename), users)
+
+    def print_summary(self, users):
+        """Print a summary to console"""
+        summary = ReportSummary()
+        for user in users:
+            summary.add(user)
+        summary.print_summary()
+
+
 def setup_logging(verbose):
     """Initialize logging"""
     logdir = os.path.join(os.getcwd(), 'logs')
@@ -401,24 +1050,49 @@ def main(args):
     setup_logging(args.verbose)
     log.info("Starting PagerDuty Orphan Users Report")
 
-    cache = PagerDutyCache(args.access_token)
+    snapshot = None
+    if args.snapshot:
+        snapshot = SnapshotStore(args.snapshot, ttl_hours=args.snapshot_ttl)
+    cache = PagerDutyCache(args.access_token, workers=args.workers,
+                           snapshot=snapshot,
+                           schedule_details=args.schedule_details,
+                           rate_limit=args.rate_limit,
+                           activity_days=args.activity_days)
     finder = OrphanUsersFinder(cache)
 
+    report_gen = ReportGenerator(args.output_dir, compress=args.gzip)
+    writers = []
+    if args.csv:
+        writers.append(report_gen.csv_writer())
+    if args.json:
+        writers.append(report_gen.json_writer())
+    if args.ndjson:
+        writers.append(report_gen.ndjson_writer())
+
     if args.full_report:
-        users = finder.find_partially_orphaned_users()
+        users = finder.iter_user_report()
     else:
-        users = finder.find_orphan_users()
-        for u in users:
-            u['is_orphan'] = True
+        users = finder.iter_orphan_users()
 
-    report_gen = ReportGenerator(args.output_dir)
-    report_gen.print_summary(users)
-
-    if args.csv:
-        report_gen.generate_csv_report(users)
-    if args.json:
-        report_gen.generate_json_report(users)
+    # Each user is written out as soon as it's computed. If the run fails
+    # part way through, the partial reports are removed rather than left
+    # looking like complete ones.
+    summary = ReportSummary()
+    try:
+        for user in users:
+            summary.add(user)
+            for writer in writers:
+                writer.write(user)
+    except BaseException:
+        for writer in writers:
+            writer.discard()
+        raise
+    summary.print_summary()
+    for writer in writers:
+        writer.close()
 
+    if snapshot is not None:
+        snapshot.close()
     log.info("Report generation complete")
     print("Script complete.")
 
@@ -444,6 +1118,18 @@ if __name__ == '__main__':
         action='store_true',
         default=False
     )
+    parser.add_argument(
+        '--ndjson', '-n',
+        help="Generate newline-delimited JSON report (one user per line)",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--gzip', '-z',
+        help="Compress report files with gzip",
+        action='store_true',
+        default=False
+    )
     parser.add_argument(
         '--full-report', '-r',
         help="Include all users with association flags, not just orphans",
@@ -457,6 +1143,56 @@ if __name__ == '__main__':
         dest='output_dir',
         default='reports'
     )
+    parser.add_argument(
+        '--schedule-details', '-d',
+        help="Fetch the details of each schedule, and find schedule users "
+             "from its layers as well as from the schedules listing. This "
+             "takes one request per schedule.",
+        dest='schedule_details',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        help="Number of schedules to fetch details of at once, with "
+             "--schedule-details (default: %d)" % DEFAULT_WORKERS,
+        dest='workers',
+        type=int,
+        default=DEFAULT_WORKERS
+    )
+    parser.add_argument(
+        '--activity-days',
+        help="Find each user's last notification and incident assignment "
+             "within this many days, from the account's log entries "
+             "(default: not checked)",
+        dest='activity_days',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--rate-limit',
+        help="Maximum API requests per second, across all concurrent "
+             "fetches; 0 for no limit (default: %d)" % DEFAULT_RATE_LIMIT,
+        dest='rate_limit',
+        type=float,
+        default=DEFAULT_RATE_LIMIT
+    )
+    parser.add_argument(
+        '--snapshot', '-s',
+        help="SQLite database file in which to store fetched resources, so "
+             "that later runs can reuse them (default: none)",
+        dest='snapshot',
+        default=None
+    )
+    parser.add_argument(
+        '--snapshot-ttl',
+        help="Hours after which listings stored in the snapshot are fetched "
+             "again in full, even if their first page and total count are "
+             "unchanged (default: %d)" % DEFAULT_SNAPSHOT_TTL_HOURS,
+        dest='snapshot_ttl',
+        type=float,
+        default=DEFAULT_SNAPSHOT_TTL_HOURS
+    )
     parser.add_argument(
         '--verbose', '-v',
         help="Verbose output",
@@ -464,4 +1200,10 @@ if __name__ == '__main__':
         default=False
     )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.activity_days is not None and args.activity_days < 1:
+        parser.error("--activity-days must be at least 1")
+    if args.rate_limit < 0:
+        parser.error("--rate-limit must not be negative")
     main(args)
\ No newline at end of file
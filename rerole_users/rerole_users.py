@@ -6,16 +6,26 @@ import argparse
 import csv
 import pagerduty
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from six.moves import input
 
 session = None
-users = {}
-teams = {}
+users = {} # Indexed by lower-case email address
+users_prefetched = False
+teams_by_id = {}
+teams_by_name = None # Indexed by lower-case name; None until retrieved
 team_members = {} # Indexed by team ID, each value a dict indexed by user ID
 valid_roles = {
         'base': ['limited_user', 'user', 'admin'],
         'team': []
     }
+# Number of roles set, skipped because unchanged, or failed, by role type
+write_stats = {
+        'base': {'set': 0, 'unchanged': 0, 'failed': 0},
+        'team': {'set': 0, 'unchanged': 0, 'failed': 0}
+    }
+write_stats_lock = threading.Lock()
 
 def decide_new_roles(args, user, per_user_base_role, per_user_team_role,
         per_user_per_team_roles=None):
@@ -124,69 +134,83 @@ def configure_new_roles(args, user, base_role, team_role, per_team_roles=None):
     # Set roles
     print("Setting roles for user: \"%s\" <%s> (ID=%s)"%(
         user['summary'], user['email'], user_id))
-    if base_role is not None:
-        set_base_role(user_id, base_role, prev_base_role)
-    if team_role is not None and not per_team_roles:
-        prev_team_roles = list(set_role_on_all_teams(user_id, team_role,
-            user['teams']))
-    if per_team_roles is not None and len(per_team_roles):
-        for (team_name, role) in per_team_roles.items():
-            team = find_team(team_name)
-            if not team:
-                print("WARNING: team not found: \"%s\"; skipping."%name)
-                continue
-            prev_role = set_user_role_on_team(user_id, role, team['id'])
-            prev_team_roles.append((role, team['name']))
+    roletype = 'base'
+    try:
+        if base_role is not None:
+            set_base_role(user_id, base_role, prev_base_role)
+        roletype = 'team'
+        if team_role is not None and not per_team_roles:
+            for prev_role in set_role_on_all_teams(user_id, team_role,
+                    user['teams']):
+                prev_team_roles.append(prev_role)
+        if per_team_roles is not None and len(per_team_roles):
+            for (team_name, role) in per_team_roles.items():
+                team = find_team(team_name)
+                if not team:
+                    print("WARNING: team not found: \"%s\"; skipping."%team_name)
+                    continue
+                prev_role = set_user_role_on_team(user_id, role, team['id'])
+                prev_team_roles.append((prev_role, team['name']))
+    except Exception as e:
+        # Roles set before the error can still be rolled back
+        count_write(roletype, 'failed')
+        e.prev_role_spec = [user['email'], prev_base_role, prev_team_roles]
+        raise
     return [user['email'], prev_base_role, prev_team_roles]
 
 def find_team(name):
     """
-    Looks up and memoizes a user based on their name.
+    Looks up a team based on its name.
 
-    :param name: Name of the team. Must be a verbatim match.
+    All teams are retrieved in one listing the first time this is called.
+
+    :param name: Name of the team (case-insensitive).
+    :returns: The team as a dictionary object, or False if not found.
     """
-    global session, teams
-    try:
-        team = teams.get(name, None)
-        if team is None:
-            team = session.find('teams', name)
-            if team is None:
-                print("WARNING: team not found: "+name)
-                teams[name] = False
-            else:
-                teams[name] = team
-        return teams[name]
-    except pagerduty.Error as e:
-        handle_exception(e)
+    global teams_by_name
+    if teams_by_name is None:
+        load_teams()
+    team = teams_by_name.get(name.lower(), False)
+    if not team:
+        print("WARNING: team not found: "+name)
+    return team
 
 def find_user(email):
     """
     Looks up and memoizes a user based on their email address.
 
-    :param email: User email address.
+    If all users have been retrieved ahead of time via :func:`prefetch_users`,
+    no API call is made.
+
+    :param email: User email address (case-insensitive).
     """
-    global session, users
+    global session, users, users_prefetched
     try:
         # Try lookup by email first
         u_params = {'include[]':['teams']}
-        user = users.get(email, None)
+        key = email.lower()
+        user = users.get(key, None)
         if user is not None:
             return user
-        user = session.find('users', email, attribute='email', params=u_params)
+        if users_prefetched:
+            user = None
+        else:
+            user = session.find('users', email, attribute='email',
+                params=u_params)
         if user is None:
             print("WARNING: user not found: "+email)
-            users[email] = False
+            users[key] = False
         else:
-            users[email] = user
-        return users[email]
+            users[key] = user
+        return users[key]
     except pagerduty.Error as e:
         handle_exception(e)
 
 def get_team(team_id):
-    global session, teams
-    if team_id not in teams:
-        teams[team_id] = session.rget('/teams/'+team_id)
-    return teams[team_id]
+    global session, teams_by_id
+    if team_id not in teams_by_id:
+        teams_by_id[team_id] = session.rget('/teams/'+team_id)
+    return teams_by_id[team_id]
 
 def get_all_rerole_operations(args):
     """
@@ -263,19 +287,49 @@ def get_team_members(team_id):
     """
     global session, team_members
     if team_id not in team_members:
-        r = session.get('teams/%s/members'%team_id)
-        if r.ok:
-            team_members.setdefault(team_id, {})
-            for member in r.json()['members']:
+        members = {}
+        try:
+            for member in session.iter_all('teams/%s/members'%team_id):
                 if not 'user' in member:
                     # Ignore if not a user
                     continue
-                team_members[team_id][member['user']['id']] = member['role']
-        else:
+                members[member['user']['id']] = member['role']
+        except pagerduty.Error as e:
             print("WARNING: couldn't retrieve members of team %s"%team_id)
-            team_members[team_id] = {}
+            handle_exception(e)
+        team_members[team_id] = members
     return team_members[team_id]
 
+def get_team_ids(rerole_ops):
+    """
+    Gets the IDs of all teams on which roles will be set.
+
+    :param rerole_ops: List of rerole operations, as returned by
+        :func:`get_all_rerole_operations`
+    :rtype: set
+    """
+    team_ids = set()
+    for (user, role_spec) in rerole_ops:
+        (base_role, team_role, per_team_roles) = role_spec
+        if per_team_roles:
+            for team_name in per_team_roles:
+                team = find_team(team_name)
+                if team:
+                    team_ids.add(team['id'])
+        elif team_role is not None:
+            team_ids.update([t['id'] for t in user['teams']])
+    return team_ids
+
+def get_team_ids_arg(team_ids):
+    """
+    Gets the list of team IDs given via the --team-ids option.
+
+    :param team_ids: List of values given to the option, each of which may be a
+        comma-separated list of IDs.
+    :rtype: list
+    """
+    return [t.strip() for v in team_ids for t in v.split(',') if t.strip()]
+
 def get_user_role_on_team(team_id, user_id):
     """Gets the current role of a user on a team."""
     global session
@@ -283,6 +337,36 @@ def get_user_role_on_team(team_id, user_id):
     if user_id in members:
        return members[user_id]
 
+def load_teams():
+    """
+    Retrieves all teams in one listing and indexes them by name and by ID.
+    """
+    global session, teams_by_id, teams_by_name
+    print("Retrieving all teams in the account...")
+    teams_by_name = {}
+    try:
+        for team in session.iter_all('teams'):
+            teams_by_id[team['id']] = team
+            teams_by_name[team['name'].lower()] = team
+    except pagerduty.Error as e:
+        handle_exception(e)
+
+def prefetch_users():
+    """
+    Retrieves all users in one listing and indexes them by email address.
+
+    This takes one request per page of users, versus one search per user when
+    looking them up individually, so it is much faster for large input files.
+    """
+    global session, users, users_prefetched
+    print("Retrieving all users in the account...")
+    try:
+        for user in session.iter_all('users', params={'include[]':['teams']}):
+            users[user['email'].lower()] = user
+        users_prefetched = True
+    except pagerduty.Error as e:
+        handle_exception(e)
+
 def get_user(email_or_name):
     global session
 
@@ -305,18 +389,40 @@ def get_users(args):
     :rtype: tuple
     """
     global session, users
-    if args.all_users:
-        print("Getting ALL users (all of them will be re-roled)...")
+    if args.all_users or args.team_ids:
+        params = {}
+        if args.team_ids:
+            # Let the API select the members of the teams
+            team_ids = get_team_ids_arg(args.team_ids)
+            params['team_ids[]'] = team_ids
+            print("Getting users on team(s) %s (all of them will be "
+                "re-roled)..."%', '.join(team_ids))
+        else:
+            print("Getting ALL users (all of them will be re-roled)...")
+        if args.current_roles:
+            # The users listing can't be filtered by role, so filter each page
+            # as it's received instead of retrieving everyone first.
+            print("Only re-roling users whose current role is: %s"%(
+                ', '.join(args.current_roles)))
         try:
-            for user in session.iter_all('users'):
-                users[user['email']] = user
+            for user in session.iter_all('users', params=params):
+                users[user['email'].lower()] = user
+                if args.current_roles and \
+                        user['role'] not in args.current_roles:
+                    continue
                 yield [user, None, None, {}]
         except Exception as e:
             handle_exception(e)
+    elif args.rollback_from:
+        print("Getting roles to restore from the rollback files...")
+        for op in get_rollback_operations(*args.rollback_from):
+            yield op
     elif args.teamroles_file is None:
         # Bring in users and roles listed in the CSV
         print("Getting users to re-role as specified in the file...")
-        roles_file = csv.reader(args.roles_file)
+        roles_file = list(csv.reader(args.roles_file))
+        if len(roles_file) > args.prefetch_threshold:
+            prefetch_users()
         for (i, item) in enumerate(roles_file):
             # Roles from CSV: Treat empty entries as meaning "do not set
             # this role and defer to the command line options"; otherwise,
@@ -354,7 +460,10 @@ def get_users(args):
     else: # Per-user-per-team roles
         print("Getting per-team roles for users as specified in the file...")
         team_roles = {}
-        roles_file = csv.reader(args.teamroles_file)
+        roles_file = list(csv.reader(args.teamroles_file))
+        if len(roles_file) > args.prefetch_threshold:
+            prefetch_users()
+        load_teams()
         for row in roles_file:
             email, team_role, team_name = [c.strip() for c in row]
             user = find_user(email)
@@ -367,7 +476,51 @@ def get_users(args):
                 team_roles.setdefault(email, {})
                 team_roles[email][team_name] = team_role
         for email in team_roles:
-            yield [users[email], None, None, team_roles[email]]
+            yield [users[email.lower()], None, None, team_roles[email]]
+
+def get_rollback_operations(rollback_file, rollback_teamroles_file):
+    """
+    Generator for restoring the roles recorded in a pair of rollback files.
+
+    All users and teams are retrieved up front, regardless of the number of
+    rows, so that no per-row lookups are necessary.
+
+    :param rollback_file: File object of a base roles rollback file, i.e. as
+        written to by the --rollback-file option
+    :param rollback_teamroles_file: File object of a team roles rollback file,
+        i.e. as written to by the --rollback-teamroles-file option
+    :yields: Lists in the same format as :func:`get_users`
+    """
+    base_roles = {}
+    team_roles = {}
+    emails = []
+    for row in csv.reader(rollback_file):
+        if not row or not row[0].strip():
+            continue
+        email = row[0].strip().lower()
+        if email not in base_roles:
+            emails.append(email)
+        base_roles[email] = row[1].strip() if len(row) > 1 else ''
+    for row in csv.reader(rollback_teamroles_file):
+        if len(row) < 3 or not row[0].strip():
+            continue
+        (email, team_role, team_name) = [c.strip() for c in row[:3]]
+        email = email.lower()
+        if not team_role or not team_name:
+            # The user was not a member of the team, so there is no role to
+            # restore on it.
+            continue
+        if email not in base_roles and email not in team_roles:
+            emails.append(email)
+        team_roles.setdefault(email, {})[team_name] = team_role
+    prefetch_users()
+    load_teams()
+    for email in emails:
+        user = find_user(email)
+        if not user:
+            continue
+        yield [user, base_roles.get(email) or None, None,
+            team_roles.get(email, {})]
 
 def get_valid_roles():
     global session, valid_roles
@@ -388,6 +541,32 @@ def handle_exception(e):
     print(msg)
     return response
 
+def prefetch_team_members(team_ids, workers):
+    """
+    Retrieves the members of the given teams concurrently.
+
+    This way, all the reads are done before any roles are set, rather than one
+    team at a time while setting them.
+
+    :param team_ids: IDs of the teams whose members to retrieve
+    :param workers: Maximum number of teams to retrieve at once
+    """
+    global team_members
+    team_ids = [t for t in team_ids if t not in team_members]
+    if not team_ids:
+        return
+    print("Retrieving members of %d team(s)..."%len(team_ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(get_team_members, team_ids))
+
+def print_write_stats():
+    """Prints how many roles were set, left unchanged or failed to be set"""
+    global write_stats
+    for roletype in ('base', 'team'):
+        print("%s roles: %d set, %d skipped (already had the role), %d "
+            "failed"%(roletype.capitalize(), write_stats[roletype]['set'],
+            write_stats[roletype]['unchanged'], write_stats[roletype]['failed']))
+
 def print_rerole_stats(rerole_stats):
     for roletype in rerole_stats:
         print("Users whose %s role will be set:"%roletype)
@@ -416,32 +595,112 @@ def rerole_users(args):
             print("Aborted.")
             return
 
-    # Proceed
-    for (user, role_spec) in rerole_ops:
-        (base_role, team_role, team_roles) = role_spec
-        prev_role_spec = configure_new_roles(args, user, base_role, team_role,
-            per_team_roles=team_roles)
-        if rf is not None:
-            # Just set base role in this file; it's not feasible to record all
-            # the team roles in this file
-            # email, base_role
-            rf.writerow(prev_role_spec[:2])
-        if trf is not None:
-            email = prev_role_spec[0]
-            for (role, team) in prev_role_spec[2]:
-                trf.writerow([email, role, team])
+    prefetch_team_members(get_team_ids(rerole_ops), args.workers)
+
+    # Proceed; users are re-roled concurrently, but rollback data is written
+    # in the original order, as soon as all users before each one are done.
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    futures = {}
+    results = {}
+    n_written = 0
+    n_failed = 0
+    try:
+        for (i, (user, role_spec)) in enumerate(rerole_ops):
+            (base_role, team_role, team_roles) = role_spec
+            futures[executor.submit(configure_new_roles, args, user, base_role,
+                team_role, per_team_roles=team_roles)] = i
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # Carry on with the other users, keeping the roles that were
+                # set before the error so that they can be rolled back
+                print("ERROR: failed to set roles for user %s: %s"%(
+                    rerole_ops[i][0].get('email'), e))
+                n_failed += 1
+                results[i] = getattr(e, 'prev_role_spec', None)
+            while n_written in results:
+                write_rollback(args, rf, trf, results.pop(n_written))
+                n_written += 1
+    finally:
+        # If interrupted, let the users already in progress finish, and record
+        # rollback data for all users that were finished regardless of order,
+        # including the roles set for a user before an error.
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for (future, i) in futures.items():
+            if i < n_written or i in results or not future.done() or \
+                    future.cancelled():
+                continue
+            if future.exception() is None:
+                results[i] = future.result()
+            else:
+                results[i] = getattr(future.exception(), 'prev_role_spec', None)
+        for i in sorted(results):
+            write_rollback(args, rf, trf, results[i])
+    print_write_stats()
+    if n_failed:
+        print("Users whose roles could not all be set due to errors: %d"%(
+            n_failed))
+
+def write_rollback(args, rf, trf, prev_role_spec):
+    """
+    Records the previous roles of a user in the rollback files.
+
+    The files are flushed immediately so that no rollback data is lost if the
+    script is interrupted.
+
+    :param args: Command line arguments namespace
+    :param rf: CSV writer for the rollback (base roles) file
+    :param trf: CSV writer for the rollback team roles file
+    :param prev_role_spec: The list returned by :func:`configure_new_roles`,
+        or None if nothing was recorded for the user
+    """
+    if prev_role_spec is None:
+        return
+    if rf is not None:
+        # Just set base role in this file; it's not feasible to record all
+        # the team roles in this file
+        # email, base_role
+        rf.writerow(prev_role_spec[:2])
+        args.rollback_file.flush()
+    if trf is not None:
+        email = prev_role_spec[0]
+        for (role, team) in prev_role_spec[2]:
+            trf.writerow([email, role, team])
+        args.rollback_teamroles_file.flush()
+
+def count_write(roletype, outcome):
+    """
+    Counts the outcome of setting a role.
+
+    :param roletype: ``base`` or ``team``
+    :param outcome: ``set``, ``unchanged`` or ``failed``
+    """
+    global write_stats
+    with write_stats_lock:
+        write_stats[roletype][outcome] += 1
 
 def set_base_role(user_id, new_base_role, prev_base_role):
     global session
+    if new_base_role == prev_base_role:
+        print("User %s already has base role %s; skipping."%(user_id,
+            new_base_role))
+        count_write('base', 'unchanged')
+        return
     try:
         print("Setting base role for user %s: %s (was %s)"%(user_id,
             new_base_role, prev_base_role))
         user = session.rput('users/'+user_id, json={"user":{"role": new_base_role}})
         if user:
             print("Successfully changed role for %s"%(user_id))
+        count_write('base', 'set')
     except pagerduty.Error as e:
         print("Failed to set role for user: "+user_id)
         handle_exception(e)
+        count_write('base', 'failed')
 
 def set_role_on_all_teams(user_id, new_team_role, teams):
     """
@@ -490,13 +749,21 @@ def set_user_role_on_team(user_id, new_team_role, team_id, add_to_teams=False):
             print("WARNING: user %s is not on team %s, so they are going to "
                 "be added. If you want to roll back changes, you will have to "
                 "remove them from this team manually."%(user_id, team_id))
+    elif prev_role == new_team_role:
+        print("User %s already has role %s on team %s; skipping."%(user_id,
+            new_team_role, team_id))
+        count_write('team', 'unchanged')
+        return prev_role
     print("Setting role of user %s on team %s to %s (was %s)"%(user_id, team_id,
         new_team_role, prev_role))
     request = session.put('teams/%s/users/%s'%(team_id, user_id), json=params)
-    if request.ok:
+    if request.status_code < 400:
         print("Success")
+        team_members.setdefault(team_id, {})[user_id] = new_team_role
+        count_write('team', 'set')
     else:
         print("API error (%d): %s"%(request.status_code, request.text))
+        count_write('team', 'failed')
     return prev_role
 
 def team_role_from_base_role(base_role, default=None):
@@ -572,6 +839,13 @@ def main():
     teamrole_args.add_argument('-u', '--auto-team-roles', dest='adapt_roles',
         required=False, default=False, action='store_true', help=helptxt)
 
+    helptxt = "Only rerole users whose current base role is this role. To "\
+        "specify multiple roles, include this option several times. Can only "\
+        "be used with --all-users or --team-ids; users are filtered as each "\
+        "page of them is retrieved."
+    parser.add_argument('--current-role', dest='current_roles',
+        action='append', default=None, help=helptxt)
+
     # Input file options
     from_file = parser.add_mutually_exclusive_group(required=True)
     helptxt = "Rerole all users in the account."
@@ -592,21 +866,49 @@ def main():
     from_file.add_argument('-t', '--team-roles-from-file',
         dest='teamroles_file', type=argparse.FileType('r'), default=None,
         help=helptxt)
+    helptxt = "Rerole all users on the team with the given ID. To specify "\
+        "multiple teams, include this option several times or give a "\
+        "comma-separated list of IDs. Users are selected by the API, so only "\
+        "members of the teams are retrieved."
+    from_file.add_argument('--team-ids', dest='team_ids', action='append',
+        default=None, help=helptxt)
+    helptxt = "Restore the base and team roles recorded in a pair of rollback "\
+        "files, i.e. as written to by the --rollback-file and "\
+        "--rollback-teamroles-file options in a previous run. All users and "\
+        "teams are retrieved up front and roles are restored concurrently. "\
+        "This cannot be combined with --new-role, --team-role or "\
+        "--auto-team-roles."
+    from_file.add_argument('--rollback-from', dest='rollback_from', nargs=2,
+        metavar=('ROLLBACK_FILE', 'ROLLBACK_TEAMROLES_FILE'), default=None,
+        type=argparse.FileType('r'), help=helptxt)
 
     # Output (save) file option:
     helptxt = "File to which the prior user base roles should be written. "\
         "Files written to with this option can then be used to reset the "\
         "permissions to the previous state before having run the rerole "\
-        "script, via the --roles-from-file option."
+        "script, via the --rollback-from option. Default: rollback.csv, or "\
+        "rollback_restore.csv when using --rollback-from."
     parser.add_argument('-b', '--rollback-file', dest='rollback_file',
-        default='rollback.csv', type=argparse.FileType('w'), help=helptxt)
+        default=None, type=argparse.FileType('w'), help=helptxt)
     helptxt = "File to which the prior user team roles should be written. "\
         "Files written to with this option can then be used to reset the "\
         "fine-grained per-user-per-team roles to the previous state before "\
-        "having run the rerole script, via the --team-roles-from-file option."
+        "having run the rerole script, via the --rollback-from option. "\
+        "Default: rollback_teamroles.csv, or rollback_restore_teamroles.csv "\
+        "when using --rollback-from."
     parser.add_argument('-m', '--rollback-teamroles-file', 
-        default='rollback_teamroles.csv', dest='rollback_teamroles_file', type=argparse.FileType('w'),
+        default=None, dest='rollback_teamroles_file', type=argparse.FileType('w'),
         help=helptxt)
+    helptxt = "If the input file has more rows than this, retrieve all users "\
+        "in the account up front in one listing, rather than searching for "\
+        "each user individually (default: 100)."
+    parser.add_argument('-p', '--prefetch-threshold', type=int, default=100,
+        dest='prefetch_threshold', help=helptxt)
+    helptxt = "Maximum number of concurrent API requests to make when "\
+        "retrieving data, and of users whose roles are set at once "\
+        "(default: 1)."
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        dest='workers', help=helptxt)
     helptxt="Assume a yes answer to all prompts i.e. to proceed in the case "\
         "that no backup file was specified."
     parser.add_argument('-y', '--yes-to-all', default=False, dest='assume_yes',
@@ -614,6 +916,27 @@ def main():
 
     args = parser.parse_args()
 
+    if args.current_roles and not (args.all_users or args.team_ids):
+        parser.error("--current-role can only be used with --all-users or "
+            "--team-ids.")
+    if args.rollback_from and (args.new_base_role or args.new_team_role or
+            args.adapt_roles):
+        parser.error("--rollback-from restores the roles given in the files; "
+            "it cannot be used with --new-role, --team-role or "
+            "--auto-team-roles.")
+    # The default rollback files are only opened now (and thus truncated) so
+    # that a previous run's files can be restored via --rollback-from without
+    # overwriting them first:
+    if args.rollback_from:
+        default_files = ('rollback_restore.csv',
+            'rollback_restore_teamroles.csv')
+    else:
+        default_files = ('rollback.csv', 'rollback_teamroles.csv')
+    if args.rollback_file is None:
+        args.rollback_file = open(default_files[0], 'w')
+    if args.rollback_teamroles_file is None:
+        args.rollback_teamroles_file = open(default_files[1], 'w')
+
     # Print a conspicuous warning message to avoid making a big mistake
     if args.all_users and not args.assume_yes:
         cont = False
@@ -625,6 +948,9 @@ def main():
             return
 
     session = pagerduty.RestApiV2Client(args.api_key)
+    # Rate limiting (429) is retried with backoff by default; also retry on
+    # transient server errors, since requests may be made concurrently.
+    session.retry.update({500: 2, 502: 4, 503: 4, 504: 4})
     rerole_users(args)
 
 if __name__=='__main__':
@@ -1,14 +1,39 @@
 #!/usr/bin/env python
 
+import argparse
+import contextlib
+import copy
+import httpx2
+import io
+import json
+import math
+import os
 import pagerduty
+import tempfile
+import time
 import unittest
 import sys
+import threading
 from unittest.mock import MagicMock, patch
 
 import rerole_users
 
+# The script keeps its state in module globals; each test starts from (and
+# leaves behind) the state that the module has when first imported.
+MODULE_STATE = dict((name, copy.deepcopy(getattr(rerole_users, name)))
+    for name in ('session', 'users', 'users_prefetched', 'teams_by_id',
+        'teams_by_name', 'team_members', 'valid_roles', 'write_stats'))
+
+def reset_module_state():
+    for (name, value) in MODULE_STATE.items():
+        setattr(rerole_users, name, copy.deepcopy(value))
+
 class ReroleUsersTest(unittest.TestCase):
 
+    def setUp(self):
+        reset_module_state()
+        self.addCleanup(reset_module_state)
+
     ##############
     # Unit Tests #
     ##############
@@ -62,6 +87,236 @@ class ReroleUsersTest(unittest.TestCase):
                 'responder')[:2]
         )
 
+    def test_find_user_prefetched(self):
+        """
+        Users can be looked up without API calls after prefetching them
+        """
+        rerole_users.session = MagicMock()
+        rerole_users.session.iter_all.return_value = iter([
+            {'id': 'PUSER01', 'email': 'Jane.Doe@example.com', 'teams': []},
+            {'id': 'PUSER02', 'email': 'john@example.com', 'teams': []}
+        ])
+        rerole_users.users = {}
+        rerole_users.prefetch_users()
+        self.assertEqual('PUSER01',
+            rerole_users.find_user('jane.doe@EXAMPLE.com')['id'])
+        self.assertFalse(rerole_users.find_user('nobody@example.com'))
+        rerole_users.session.find.assert_not_called()
+
+    def test_prefetch_team_members(self):
+        """
+        Members of all teams that roles will be set on are retrieved up front
+        """
+        members = {
+            'PTEAM01': [{'user': {'id': 'PUSER%02d'%i}, 'role': 'manager'}
+                for i in range(150)],
+            'PTEAM02': [{'user': {'id': 'PUSER01'}, 'role': 'observer'},
+                {'escalation_policy': {'id': 'PESCPOL'}, 'role': 'responder'}]
+        }
+        rerole_users.session = MagicMock()
+        rerole_users.session.iter_all.side_effect = lambda url: \
+            iter(members[url.split('/')[1]])
+        rerole_users.team_members = {}
+        user = {'id': 'PUSER01', 'teams': [{'id': 'PTEAM01'},
+            {'id': 'PTEAM02'}]}
+        rerole_ops = [[user, ['observer', 'responder', {}]],
+            [user, ['observer', None, {}]]]
+        team_ids = rerole_users.get_team_ids(rerole_ops)
+        self.assertEqual({'PTEAM01', 'PTEAM02'}, team_ids)
+        rerole_users.prefetch_team_members(team_ids, 2)
+        self.assertEqual(150, len(rerole_users.team_members['PTEAM01']))
+        self.assertEqual({'PUSER01': 'observer'},
+            rerole_users.team_members['PTEAM02'])
+        self.assertEqual('observer',
+            rerole_users.get_user_role_on_team('PTEAM02', 'PUSER01'))
+        self.assertEqual(2, rerole_users.session.iter_all.call_count)
+
+    def test_rerole_users_rollback_order(self):
+        """
+        Rollback data is written in input order when users finish out of order
+        """
+        n_users = 20
+        rerole_ops = [[{'email': 'user%02d@example.com'%i}, [None, None, {}]]
+            for i in range(n_users)]
+        def configure_new_roles(args, user, *a, **kw):
+            # Later users finish first
+            time.sleep((n_users - int(user['email'][4:6]))/1000.0)
+            return [user['email'], 'user', [('manager', 'Team '+user['email'])]]
+        args = MagicMock()
+        args.assume_yes = True
+        args.workers = 8
+        with tempfile.TemporaryDirectory() as tmpdir:
+            args.rollback_file = open(os.path.join(tmpdir, 'rb.csv'), 'w')
+            args.rollback_teamroles_file = open(os.path.join(tmpdir,
+                'rbt.csv'), 'w')
+            with patch.object(rerole_users, 'get_all_rerole_operations',
+                        return_value=iter(rerole_ops)), \
+                    patch.object(rerole_users, 'get_team_ids',
+                        return_value=set()), \
+                    patch.object(rerole_users, 'configure_new_roles',
+                        side_effect=configure_new_roles):
+                rerole_users.rerole_users(args)
+            args.rollback_file.close()
+            args.rollback_teamroles_file.close()
+            expected = ['user%02d@example.com,user'%i for i in range(n_users)]
+            self.assertEqual(expected,
+                open(args.rollback_file.name).read().splitlines())
+            expected = ['user%02d@example.com,manager,Team user%02d@example.com'
+                %(i, i) for i in range(n_users)]
+            self.assertEqual(expected,
+                open(args.rollback_teamroles_file.name).read().splitlines())
+
+    def test_rerole_users_rollback_after_error(self):
+        """
+        An error for one user doesn't stop the others, and the roles set for
+        that user before the error are still recorded for rollback
+        """
+        rerole_users.session = MagicMock()
+        rerole_users.team_members = {
+            'PTEAM01': {'PUSER01': 'responder', 'PUSER02': 'observer'},
+            'PTEAM02': {'PUSER01': 'responder'}}
+        rerole_users.write_stats = {
+            'base': {'set': 0, 'unchanged': 0, 'failed': 0},
+            'team': {'set': 0, 'unchanged': 0, 'failed': 0}
+        }
+        rerole_users.session.put.side_effect = [FakeResponse(),
+            pagerduty.Error('Timed out'), FakeResponse()]
+        rerole_ops = [
+            [{'id': 'PUSER01', 'email': 'user01@example.com',
+                'summary': 'User 01', 'role': 'user',
+                'teams': [{'id': 'PTEAM01', 'summary': 'Team 01'},
+                    {'id': 'PTEAM02', 'summary': 'Team 02'}]},
+                ['observer', 'manager', {}]],
+            [{'id': 'PUSER02', 'email': 'user02@example.com',
+                'summary': 'User 02', 'role': 'user',
+                'teams': [{'id': 'PTEAM01', 'summary': 'Team 01'}]},
+                ['observer', 'manager', {}]]
+        ]
+        args = MagicMock()
+        args.assume_yes = True
+        args.workers = 1
+        with tempfile.TemporaryDirectory() as tmpdir:
+            args.rollback_file = open(os.path.join(tmpdir, 'rb.csv'), 'w')
+            args.rollback_teamroles_file = open(os.path.join(tmpdir,
+                'rbt.csv'), 'w')
+            with patch.object(rerole_users, 'get_all_rerole_operations',
+                        return_value=iter(rerole_ops)), \
+                    patch.object(rerole_users, 'get_team_ids',
+                        return_value=set()):
+                rerole_users.rerole_users(args)
+            args.rollback_file.close()
+            args.rollback_teamroles_file.close()
+            self.assertEqual(2, rerole_users.session.rput.call_count)
+            self.assertEqual({'set': 2, 'unchanged': 0, 'failed': 1},
+                rerole_users.write_stats['team'])
+            self.assertEqual(['user01@example.com,user',
+                    'user02@example.com,user'],
+                open(args.rollback_file.name).read().splitlines())
+            self.assertEqual(['user01@example.com,responder,Team 01',
+                    'user02@example.com,observer,Team 01'],
+                open(args.rollback_teamroles_file.name).read().splitlines())
+
+    def test_skip_unchanged_roles(self):
+        """
+        No requests are made to set roles that a user already has
+        """
+        rerole_users.session = MagicMock()
+        rerole_users.session.put.return_value = FakeResponse()
+        rerole_users.team_members = {'PTEAM01': {'PUSER01': 'manager'}}
+        rerole_users.write_stats = {
+            'base': {'set': 0, 'unchanged': 0, 'failed': 0},
+            'team': {'set': 0, 'unchanged': 0, 'failed': 0}
+        }
+        rerole_users.set_base_role('PUSER01', 'observer', 'observer')
+        rerole_users.set_user_role_on_team('PUSER01', 'manager', 'PTEAM01')
+        rerole_users.session.rput.assert_not_called()
+        rerole_users.session.put.assert_not_called()
+        rerole_users.set_base_role('PUSER01', 'limited_user', 'observer')
+        rerole_users.set_user_role_on_team('PUSER01', 'observer', 'PTEAM01')
+        rerole_users.session.rput.assert_called_once()
+        rerole_users.session.put.assert_called_once()
+        self.assertEqual('observer',
+            rerole_users.get_user_role_on_team('PTEAM01', 'PUSER01'))
+        self.assertEqual({'set': 1, 'unchanged': 1, 'failed': 0},
+            rerole_users.write_stats['base'])
+        self.assertEqual({'set': 1, 'unchanged': 1, 'failed': 0},
+            rerole_users.write_stats['team'])
+
+    def test_find_team(self):
+        """
+        Teams are found by name from a single listing, and by ID
+        """
+        rerole_users.session = MagicMock()
+        rerole_users.session.iter_all.return_value = iter([
+            {'id': 'PTEAM01', 'name': 'Team A', 'summary': 'Team A'},
+            {'id': 'PTEAM02', 'name': 'PTEAM01', 'summary': 'PTEAM01'}
+        ])
+        rerole_users.teams_by_id = {}
+        rerole_users.teams_by_name = None
+        self.assertEqual('PTEAM01', rerole_users.find_team('team a')['id'])
+        self.assertEqual('PTEAM02', rerole_users.find_team('PTEAM01')['id'])
+        self.assertFalse(rerole_users.find_team('Team B'))
+        self.assertEqual('Team A', rerole_users.get_team('PTEAM01')['name'])
+        rerole_users.session.iter_all.assert_called_once_with('teams')
+        rerole_users.session.find.assert_not_called()
+        rerole_users.session.rget.assert_not_called()
+
+    def test_get_rollback_operations(self):
+        """
+        Roles are restored from rollback files using one user and team listing
+        """
+        listings = {
+            'users': [
+                {'id': 'PUSER01', 'email': 'jane@example.com', 'role': 'user',
+                    'teams': []},
+                {'id': 'PUSER02', 'email': 'john@example.com', 'role': 'user',
+                    'teams': []}
+            ],
+            'teams': [
+                {'id': 'PTEAM01', 'name': 'Team A', 'summary': 'Team A'},
+                {'id': 'PTEAM02', 'name': 'Team B', 'summary': 'Team B'}
+            ]
+        }
+        rerole_users.session = MagicMock()
+        rerole_users.session.iter_all.side_effect = lambda url, **kw: \
+            iter(listings[url])
+        rerole_users.users = {}
+        rerole_users.teams_by_id = {}
+        rerole_users.teams_by_name = None
+        rollback_file = io.StringIO("jane@example.com,observer\n"
+            "John@example.com,limited_user\nnobody@example.com,user\n")
+        rollback_teamroles_file = io.StringIO("jane@example.com,manager,"
+            "Team A\njane@example.com,,Team B\njohn@example.com,responder,"
+            "Team B\n")
+        ops = list(rerole_users.get_rollback_operations(rollback_file,
+            rollback_teamroles_file))
+        self.assertEqual([
+                ['PUSER01', 'observer', None, {'Team A': 'manager'}],
+                ['PUSER02', 'limited_user', None, {'Team B': 'responder'}]
+            ], [[op[0]['id']] + op[1:] for op in ops])
+        self.assertEqual(2, rerole_users.session.iter_all.call_count)
+        rerole_users.session.find.assert_not_called()
+
+    def test_get_users_by_team_and_role(self):
+        """
+        Users are selected by team via the API and filtered by current role
+        """
+        rerole_users.session = MagicMock()
+        rerole_users.session.iter_all.return_value = iter([
+            {'id': 'PUSER01', 'email': 'jane@example.com', 'role': 'user'},
+            {'id': 'PUSER02', 'email': 'john@example.com', 'role': 'admin'},
+            {'id': 'PUSER03', 'email': 'joe@example.com', 'role': 'observer'}
+        ])
+        rerole_users.users = {}
+        args = MagicMock()
+        args.all_users = False
+        args.team_ids = ['PTEAM01,PTEAM02', 'PTEAM03']
+        args.current_roles = ['user', 'observer']
+        self.assertEqual(['PUSER01', 'PUSER03'],
+            [op[0]['id'] for op in rerole_users.get_users(args)])
+        rerole_users.session.iter_all.assert_called_once_with('users',
+            params={'team_ids[]': ['PTEAM01', 'PTEAM02', 'PTEAM03']})
+
     ####################
     # Functional Tests #
     ####################
@@ -81,6 +336,11 @@ class ReroleUsersTest(unittest.TestCase):
         args = MagicMock()
         args.assume_yes = True
         args.skip_roles = ['owner']
+        args.prefetch_threshold = 100
+        args.workers = 4
+        args.rollback_from = None
+        args.team_ids = None
+        args.current_roles = None
         # Step 1: Run a rerole then the inverse (WARNING: can mess up account)
         args.rollback_file = open(rbf(1), 'w')
         args.rollback_teamroles_file = open(rbtrf(1), 'w')
@@ -119,6 +379,249 @@ class ReroleUsersTest(unittest.TestCase):
             self.assertEqual(open(rolefile(1), 'r').read(),
                 open(rolefile(3), 'r').read())
 
+def FakeResponse(status_code=200, text=''):
+    """Response of a PUT request, of the same type the real client returns"""
+    return httpx2.Response(status_code, text=text)
+
+class FakeAccount(object):
+    """
+    In-memory fake of the PagerDuty REST API endpoints used by rerole_users.
+
+    It answers HTTP requests sent through a mock transport, so the script uses
+    a real API client, and the requests counted are the ones that the client
+    actually makes, e.g. one per page of a listing.
+    """
+
+    roles = ['user', 'limited_user', 'observer', 'admin', 'restricted_access']
+
+    def __init__(self, n_users, n_teams=0):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.teams = [{'id': 'PTEAM%03d'%t, 'name': 'Team %d'%t,
+            'summary': 'Team %d'%t} for t in range(n_teams)]
+        self.users = {}
+        # Team ID -> user ID -> role on team
+        self.members = dict((team['id'], {}) for team in self.teams)
+        for i in range(n_users):
+            user_id = 'PUSER%05d'%i
+            user = {'id': user_id, 'email': 'user%05d@example.com'%i,
+                'name': 'User %d'%i, 'summary': 'User %d'%i,
+                'role': 'owner' if i == 0 else self.roles[i%len(self.roles)],
+                'teams': []}
+            if n_teams:
+                team = self.teams[i%n_teams]
+                user['teams'].append({'id': team['id'],
+                    'summary': team['summary']})
+                self.members[team['id']][user_id] = 'manager'
+            self.users[user_id] = user
+
+    def client(self):
+        """A REST API client whose requests are all answered by this account"""
+        return pagerduty.RestApiV2Client('fake-api-key',
+            transport=httpx2.MockTransport(self.handle))
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def copy_user(self, user):
+        return dict(user, teams=[dict(t) for t in user['teams']])
+
+    def respond(self, body=None, status_code=200):
+        # A streamed body, so that the client times the response as it would
+        # one received over the network
+        content = b'' if body is None else json.dumps(body).encode()
+        return httpx2.Response(status_code, stream=httpx2.ByteStream(content),
+            headers={'Content-Type': 'application/json'})
+
+    def page(self, wrapper, items, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 25))
+        return self.respond({wrapper: items[offset:offset+limit],
+            'offset': offset, 'limit': limit,
+            'more': offset+limit < len(items)})
+
+    def handle(self, request):
+        nodes = request.url.path.strip('/').split('/')
+        params = request.url.params
+        path = '/'.join([n if i % 2 == 0 else '{id}'
+            for (i, n) in enumerate(nodes)])
+        self.count('%s %s'%(request.method, path))
+        with self.lock:
+            if request.method == 'GET' and path == 'abilities':
+                return self.respond({'abilities': ['teams',
+                    'advanced_permissions']})
+            elif request.method == 'GET' and path == 'users':
+                items = list(self.users.values())
+                team_ids = set(params.get_list('team_ids[]'))
+                if team_ids:
+                    items = [u for u in items if team_ids & set(t['id']
+                        for t in u['teams'])]
+                query = params.get('query', '').lower()
+                if query:
+                    items = [u for u in items if query in u['email'].lower()
+                        or query in u['name'].lower()]
+                return self.page('users', [self.copy_user(u) for u in items],
+                    params)
+            elif request.method == 'GET' and path == 'teams':
+                return self.page('teams', [dict(t) for t in self.teams],
+                    params)
+            elif request.method == 'GET' and path == 'teams/{id}':
+                team = [t for t in self.teams if t['id'] == nodes[1]][0]
+                return self.respond({'team': dict(team)})
+            elif request.method == 'GET' and path == 'teams/{id}/members':
+                items = [{'user': {'id': user_id}, 'role': role} for (user_id,
+                    role) in self.members[nodes[1]].items()]
+                return self.page('members', items, params)
+            elif request.method == 'PUT' and path == 'users/{id}':
+                user = self.users[nodes[1]]
+                user['role'] = json.loads(request.content)['user']['role']
+                return self.respond({'user': self.copy_user(user)})
+            elif request.method == 'PUT' and path == 'teams/{id}/users/{id}':
+                self.members[nodes[1]][nodes[3]] = json.loads(
+                    request.content)['role']
+                return self.respond(status_code=204)
+        return self.respond({'error': {'message': 'Not Found'}}, 404)
+
+class ReroleUsersIntegrationTest(unittest.TestCase):
+    """
+    Runs re-roles end to end against a fake account and checks the number of
+    API calls that each mode of operation makes.
+    """
+
+    def setUp(self):
+        reset_module_state()
+        self.addCleanup(reset_module_state)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.n_runs = 0
+
+    def make_args(self, **kw):
+        args = argparse.Namespace(all_users=False, roles_file=None,
+            teamroles_file=None, team_ids=None, rollback_from=None,
+            current_roles=None, new_base_role=None, new_team_role=None,
+            adapt_roles=False, skip_roles=['owner'], prefetch_threshold=100,
+            workers=4, assume_yes=True)
+        args.__dict__.update(kw)
+        self.n_runs += 1
+        args.rollback_file = open(self.path('rollback_%d.csv'%self.n_runs), 'w')
+        args.rollback_teamroles_file = open(self.path('rollback_teamroles_%d.csv'
+            %self.n_runs), 'w')
+        return args
+
+    def path(self, filename):
+        return os.path.join(self.tmpdir.name, filename)
+
+    def run_rerole(self, account, args):
+        """Re-roles users as if running the script anew; returns call counts"""
+        reset_module_state()
+        rerole_users.session = account.client()
+        account.calls = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            rerole_users.rerole_users(args)
+        args.rollback_file.close()
+        args.rollback_teamroles_file.close()
+        return account.calls
+
+    def write_csv(self, filename, rows):
+        with open(self.path(filename), 'w') as f:
+            f.write(''.join(','.join(row)+'\n' for row in rows))
+        return open(self.path(filename), 'r')
+
+    def test_all_users_base_role(self):
+        account = FakeAccount(1000)
+        n_changed = len([u for u in account.users.values()
+            if u['role'] not in ('owner', 'observer')])
+        calls = self.run_rerole(account, self.make_args(all_users=True,
+            new_base_role='observer'))
+        self.assertEqual({'GET abilities': 1, 'GET users': 10,
+            'PUT users/{id}': n_changed}, calls)
+        # Running it again only reads
+        calls = self.run_rerole(account, self.make_args(all_users=True,
+            new_base_role='observer'))
+        self.assertEqual({'GET abilities': 1, 'GET users': 10}, calls)
+
+    def test_all_users_team_role(self):
+        account = FakeAccount(1000, n_teams=20)
+        calls = self.run_rerole(account, self.make_args(all_users=True,
+            new_team_role='responder'))
+        self.assertEqual({'GET abilities': 1, 'GET users': 10,
+            'GET teams/{id}/members': 20, 'PUT teams/{id}/users/{id}': 999},
+            calls)
+
+    def test_roles_file(self):
+        account = FakeAccount(1000)
+        # Below the prefetch threshold: users are searched for individually
+        rows = [['user%05d@example.com'%i, 'observer'] for i in range(1, 51)]
+        n_changed = len([r for r in rows if account.users['PUSER'+r[0][4:9]][
+            'role'] != 'observer'])
+        calls = self.run_rerole(account, self.make_args(
+            roles_file=self.write_csv('roles_small.csv', rows)))
+        self.assertEqual({'GET abilities': 1, 'GET users': 50,
+            'PUT users/{id}': n_changed}, calls)
+        # Above it: all users are retrieved in one listing
+        rows = [['user%05d@example.com'%i, 'limited_user']
+            for i in range(1, 501)]
+        n_changed = len([r for r in rows if account.users['PUSER'+r[0][4:9]][
+            'role'] != 'limited_user'])
+        calls = self.run_rerole(account, self.make_args(
+            roles_file=self.write_csv('roles_large.csv', rows)))
+        self.assertEqual({'GET abilities': 1, 'GET users': 10,
+            'PUT users/{id}': n_changed}, calls)
+
+    def test_team_roles_file(self):
+        account = FakeAccount(2000, n_teams=40)
+        rows = [[u['email'], 'observer', u['teams'][0]['summary']]
+            for u in account.users.values() if u['teams'][0]['id'] in (
+                'PTEAM000', 'PTEAM001', 'PTEAM002')]
+        calls = self.run_rerole(account, self.make_args(
+            teamroles_file=self.write_csv('teamroles.csv', rows)))
+        # The account owner (on the first team) is skipped
+        self.assertEqual({'GET abilities': 1, 'GET users': 20, 'GET teams': 1,
+            'GET teams/{id}/members': 3,
+            'PUT teams/{id}/users/{id}': len(rows)-1}, calls)
+
+    def test_team_ids_and_current_role(self):
+        account = FakeAccount(20000, n_teams=99)
+        team_users = [u for u in account.users.values()
+            if u['teams'][0]['id'] == 'PTEAM007']
+        n_changed = len([u for u in team_users if u['role'] == 'limited_user'])
+        calls = self.run_rerole(account, self.make_args(team_ids=['PTEAM007'],
+            current_roles=['limited_user'], new_base_role='observer'))
+        self.assertEqual({'GET abilities': 1,
+            'GET users': math.ceil(len(team_users)/100.0),
+            'PUT users/{id}': n_changed}, calls)
+
+    def test_all_users_current_role(self):
+        # The most that can be listed with classic pagination
+        account = FakeAccount(10000)
+        n_admins = len([u for u in account.users.values()
+            if u['role'] == 'admin'])
+        calls = self.run_rerole(account, self.make_args(all_users=True,
+            current_roles=['admin'], new_base_role='user'))
+        self.assertEqual({'GET abilities': 1, 'GET users': 100,
+            'PUT users/{id}': n_admins}, calls)
+
+    def test_rollback_from(self):
+        account = FakeAccount(3000, n_teams=30)
+        before = dict((u['id'], u['role']) for u in account.users.values())
+        before_members = dict((t, dict(m)) for (t, m) in
+            account.members.items())
+        args = self.make_args(all_users=True, new_base_role='observer',
+            new_team_role='responder')
+        self.run_rerole(account, args)
+        n_base = len([r for r in before.values()
+            if r not in ('owner', 'observer')])
+        calls = self.run_rerole(account, self.make_args(rollback_from=[
+            open(args.rollback_file.name), open(args.rollback_teamroles_file.name)
+        ]))
+        self.assertEqual({'GET abilities': 1, 'GET users': 30, 'GET teams': 1,
+            'GET teams/{id}/members': 30, 'PUT users/{id}': n_base,
+            'PUT teams/{id}/users/{id}': 2999}, calls)
+        self.assertEqual(before, dict((u['id'], u['role'])
+            for u in account.users.values()))
+        self.assertEqual(before_members, account.members)
+
 if __name__ == '__main__':
     global api_key
     api_key = ''
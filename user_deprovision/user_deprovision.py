@@ -28,11 +28,15 @@
 # PagerDuty Support asset: user_deprovision
 
 import argparse
+import copy
 import json
 import logging
 import os
 import time
 import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 from six.moves import input
@@ -40,23 +44,215 @@ from pagerduty import RestApiV2Client, Error
 
 log = logging.getLogger('user_deprovision')
 
+# Number of schedules whose details are fetched at once by --simulate
+SIMULATE_DETAIL_WORKERS = 8
+
+
+def endpoint_key(method, url):
+    """
+    Summarizes a request as a method and a path with IDs replaced by "{id}"
+
+    i.e. ``put:schedules/{id}`` or ``delete:teams/{id}/users/{id}``
+    """
+    if '://' in url:
+        url = url.split('://', 1)[1].split('/', 1)[-1]
+    nodes = url.split('?')[0].strip('/').split('/')
+    path = '/'.join([n if i % 2 == 0 else '{id}' for (i, n) in enumerate(nodes)])
+    return '%s:%s' % (method.lower(), path)
+
+
+class DeprovisionClient(RestApiV2Client):
+    """
+    REST API client shared by all users processed in a run.
+
+    Connections are pooled and kept alive for the duration of the run, and
+    transient server errors are retried with backoff (the base class already
+    retries when rate limited). Each API call is also recorded by
+    ``recorder``, which is pointed at the :class:`CallRecorder` of the user
+    currently being processed in the calling thread.
+    """
+
+    retry_on_status = {500: 2, 502: 4, 503: 4, 504: 4}
+
+    def __init__(self, access_token, from_email):
+        super(DeprovisionClient, self).__init__(access_token, default_from=from_email)
+        self.retry.update(self.retry_on_status)
+        self._local = threading.local()
+
+    @property
+    def recorder(self):
+        return getattr(self._local, 'recorder', None)
+
+    @recorder.setter
+    def recorder(self, recorder):
+        self._local.recorder = recorder
+
+    def request(self, method, url, **kwargs):
+        # Responses received so far for this request, including retries
+        self._local.responses = 0
+        return super(DeprovisionClient, self).request(method, url, **kwargs)
+
+    def postprocess(self, response, *args, **kw):
+        super(DeprovisionClient, self).postprocess(response, *args, **kw)
+        # Every response after the first means that the previous one was
+        # retried, whereas the last one of a request never is
+        responses = getattr(self._local, 'responses', 0)
+        self._local.responses = responses + 1
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record_call(response.request.method,
+                                 str(response.request.url), responses > 0)
+
+
+class CallRecorder(object):
+    """
+    Records the wall time and API calls made, broken down by phase.
+    """
+
+    phase_counters = ('get', 'put', 'delete', 'retries')
+
+    def __init__(self):
+        # API calls made, indexed by endpoint
+        self.api_call_counts = {}
+        # Wall time and call counts, indexed by phase name
+        self.phases = {}
+        self.current_phase = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def empty_stats(cls):
+        stats = dict.fromkeys(cls.phase_counters, 0)
+        stats['wall_time'] = 0.0
+        return stats
+
+    @contextmanager
+    def phase(self, name):
+        """Attributes API calls made within the context to a named phase"""
+        stats = self.phases.setdefault(name, self.empty_stats())
+        self.current_phase = stats
+        start = time.time()
+        try:
+            yield stats
+        finally:
+            stats['wall_time'] += time.time() - start
+            self.current_phase = None
+
+    def record_call(self, method, url, retried):
+        key = endpoint_key(method, url)
+        with self.lock:
+            self.api_call_counts[key] = self.api_call_counts.get(key, 0) + 1
+            if self.current_phase is not None:
+                method = method.lower()
+                if method in self.current_phase:
+                    self.current_phase[method] += 1
+                if retried:
+                    self.current_phase['retries'] += 1
+
+    def totals(self):
+        """Sums wall time and call counts over all phases"""
+        totals = self.empty_stats()
+        for stats in self.phases.values():
+            for (key, value) in stats.items():
+                totals[key] += value
+        return totals
+
+
+class RunReport(CallRecorder):
+    """
+    Machine-readable report of a run: API calls made and time spent by each
+    user and phase, and in total.
+    """
+
+    def __init__(self, workers):
+        super(RunReport, self).__init__()
+        self.workers = workers
+        self.started_at = datetime.now()
+        self.start = time.time()
+        self.users = []
+        self.failures = []
+        self.users_lock = threading.Lock()
+
+    def add_user(self, user_deleter):
+        with self.users_lock:
+            self.users.append(user_deleter)
+
+    def add_failure(self, email, error):
+        """Records an error that stopped a user from being deprovisioned"""
+        with self.users_lock:
+            self.failures.append({
+                'email': email,
+                'error': '%s: %s' % (type(error).__name__, error)
+            })
+
+    def as_dict(self):
+        users = []
+        phases = {}
+        for recorder in [self] + self.users:
+            for (name, stats) in recorder.phases.items():
+                phase_totals = phases.setdefault(name, self.empty_stats())
+                for (key, value) in stats.items():
+                    phase_totals[key] += value
+        for user_deleter in self.users:
+            users.append({
+                'email': user_deleter.email,
+                'user_id': user_deleter.user_id or None,
+                'deleted': user_deleter.deleted,
+                'phases': user_deleter.phases,
+                'totals': user_deleter.totals()
+            })
+        totals = dict.fromkeys(self.phase_counters, 0)
+        for stats in phases.values():
+            for key in self.phase_counters:
+                totals[key] += stats[key]
+        totals['wall_time'] = time.time() - self.start
+        return {
+            'started_at': self.started_at.isoformat(),
+            'workers': self.workers,
+            'phases': phases,
+            'totals': totals,
+            'users': users,
+            'failures': self.failures
+        }
+
+    def write(self, filename):
+        with open(filename, 'w') as fh:
+            json.dump(self.as_dict(), fh, indent=2)
+
 
 class Resources:
     def __init__(self, access_token, from_email):
         self.schedules = None
         self.teams = None
-        self.session = RestApiV2Client(access_token, default_from=from_email)
+        self.escalation_policies = None
+        self.escalation_policies_by_id = {}
+        self.escalation_policies_by_user = {}
+        self.services = None
+        self.users_by_email = None
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.session = DeprovisionClient(access_token, from_email)
 
-    def get_schedules(self):
+    def get_schedules(self, workers=1):
+        """
+        Retrieves all schedules and their details, the latter on up to
+        ``workers`` threads at once.
+        """
         if self.schedules is None:
             log.info("Retrieving all schedules on the account. This could take several minutes.")
             print("Retrieving all schedules on the account. This could take several minutes.")
             self.schedules = self.session.list_all('schedules')
 
             log.info("Retrieving a list of users for each schedule. This could take several minutes.")
-            for schedule in self.schedules:
+            # Calls made by the pool are recorded wherever the caller's are
+            recorder = self.session.recorder
+
+            def get_details(schedule):
+                self.session.recorder = recorder
                 schedule['details'] = self.session.rget(schedule.get('self'))
 
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(get_details, self.schedules))
+
         return self.schedules
 
     def get_teams(self):
@@ -71,6 +267,91 @@ class Resources:
 
         return self.teams
 
+    def get_escalation_policies(self):
+        if self.escalation_policies is None:
+            log.info("Retrieving all escalation policies on the account. This could take several minutes.")
+            print("Retrieving all escalation policies on the account. This could take several minutes.")
+            self.escalation_policies = self.session.list_all('escalation_policies')
+
+            # Index by ID and by user target so that each user's escalation
+            # policies can be looked up without any further API calls
+            for ep in self.escalation_policies:
+                self.escalation_policies_by_id[ep['id']] = ep
+            self.escalation_policies_by_user = index_escalation_policies_by_user(
+                self.escalation_policies)
+
+        return self.escalation_policies
+
+    def get_services(self):
+        if self.services is None:
+            log.info("Retrieving all services on the account. This could take several minutes.")
+            print("Retrieving all services on the account. This could take several minutes.")
+            self.services = self.session.list_all('services')
+        return self.services
+
+    def get_users_by_email(self):
+        """Get all users on the account, indexed by lower-case login email"""
+        if self.users_by_email is None:
+            log.info("Retrieving all users on the account. This could take several minutes.")
+            print("Retrieving all users on the account. This could take several minutes.")
+            self.users_by_email = {}
+            for user in self.session.iter_all('users'):
+                self.users_by_email[user['email'].lower()] = user
+        return self.users_by_email
+
+    def lock(self, obj_id):
+        """
+        Get the lock that serializes changes to a given object.
+
+        Changes to the same schedule, escalation policy or team must not be made
+        for two users at once; otherwise one update would overwrite the other.
+        """
+        with self.locks_lock:
+            return self.locks.setdefault(obj_id, threading.Lock())
+
+    def get_escalation_policy(self, ep_id):
+        """Get a cached escalation policy by ID, or None if not cached"""
+        self.get_escalation_policies()
+        return self.escalation_policies_by_id.get(ep_id)
+
+    def get_user_escalation_policies(self, user_id):
+        """List all escalation policies that have the user as a target"""
+        self.get_escalation_policies()
+        return self.escalation_policies_by_user.get(user_id, [])
+
+
+def index_escalation_policies_by_user(escalation_policies):
+    """
+    Indexes escalation policies by the IDs of the users that they target.
+
+    :returns: dict mapping user IDs to lists of escalation policies
+    """
+    index = {}
+    for ep in escalation_policies:
+        user_ids = set()
+        for rule in ep.get('escalation_rules', []):
+            for target in rule.get('targets', []):
+                if target['type'].startswith('user'):
+                    user_ids.add(target['id'])
+        for user_id in user_ids:
+            index.setdefault(user_id, []).append(ep)
+    return index
+
+
+def schedule_payload(schedule):
+    """
+    Makes a copy of a schedule that can be sent in a PUT request.
+
+    :param schedule:
+        Schedule dictionary object
+    """
+    payload = dict(schedule)
+    # Reverse the order before saving because of a known issue
+    payload['schedule_layers'] = schedule['schedule_layers'][::-1]
+    # Remove read-only property
+    payload.pop('users', None)
+    return payload
+
 
 def handle_exception(e):
     r = e.response
@@ -97,20 +378,28 @@ def input_yn(message):
         return input_yn(message)
 
 
-class DeleteUser(RestApiV2Client):
+class DeleteUser(CallRecorder):
     """Class to handle all user deletion logic.
-    
-    REST API access methods are inherited from pagerduty.RestApiV2Client.
+
+    Holds the state of a single user being deleted; REST API calls are made
+    through a client that is shared by all users in the run.
     """
 
-    def __init__(self, access_token, email, from_email, backup):
-        super(DeleteUser, self).__init__(access_token, default_from=from_email)
+    def __init__(self, session, email, backup, user=None):
+        super(DeleteUser, self).__init__()
+        self.session = session
         self.email = email
         self.backup = backup
+        self.deleted = False
+        # The user may be given if already retrieved, i.e. in a bulk listing
+        self._user = user
+        # Record API calls made in this thread on behalf of this user
+        self.session.recorder = self
         # Memoize user and set user_id property for convenience
         self.user_id = False
-        if self.user is not None:
-            self.user_id = self.user['id']
+        with self.phase('lookup'):
+            if self.user is not None:
+                self.user_id = self.user['id']
 
     def backup_object(self, url, modification):
         """
@@ -139,18 +428,29 @@ class DeleteUser(RestApiV2Client):
             json.dump(obj, fh)
             fh.close()
 
-    def delete(self, url, **kw):
+    def rdelete(self, url, **kw):
         """
         Delete an object, optionally making a backup first.
         """
         if self.backup:
             self.backup_object(url, 'deleted')
-        return super(DeleteUser, self).delete(url, **kw)
+        return self.session.rdelete(url, **kw)
 
     def delete_user(self):
         """Delete user from PagerDuty"""
-        r = self.delete('users/' + self.user_id)
-        return r.ok
+        try:
+            self.rdelete('users/' + self.user_id)
+            self.deleted = True
+            return True
+        except Error as e:
+            handle_exception(e)
+            return False
+
+    def find(self, resource, query, **kw):
+        return self.session.find(resource, query, **kw)
+
+    def list_all(self, url, **kw):
+        return self.session.list_all(url, **kw)
 
     def list_open_incidents(self, additional_params=None):
         """
@@ -187,13 +487,6 @@ class DeleteUser(RestApiV2Client):
                 handle_exception(e)
                 log.error("Could not resolve incident %s.", incident['id'])
 
-    @property
-    def escalation_policies(self):
-        """List all escalation policies user is on"""
-        if not hasattr(self, '_escalation_policies'):
-            self._escalation_policies = self.list_all('escalation_policies', params={'user_ids[]': self.user_id})
-        return self._escalation_policies
-
     def schedule_has_user(self, schedule):
         """Check if a schedule contains a particular user"""
         for user in schedule.get('users', []):
@@ -239,6 +532,13 @@ class DeleteUser(RestApiV2Client):
         """
         new_layers = []
         not_empty = False
+        # A layer ended by removing an earlier user still lists that user,
+        # because it can't be saved without any; only users who are still on
+        # the schedule keep a layer occupied.
+        remaining_ids = None
+        if 'users' in schedule:
+            remaining_ids = set(u.get('id') for u in schedule['users']
+                                if u.get('id') != self.user_id)
         for layer in schedule['schedule_layers']:
             # Get index of user in layer
             new_users = []
@@ -252,12 +552,15 @@ class DeleteUser(RestApiV2Client):
                 layer['end'] = datetime.now().isoformat()
             else:
                 layer['users'] = new_users
-                not_empty = True
+                if remaining_ids is None or \
+                        any(u['user']['id'] in remaining_ids for u in new_users):
+                    not_empty = True
             new_layers.append(layer)
-        # Reverse the order before saving because of a known issue
-        schedule['schedule_layers'] = new_layers[::-1]
-        # Remove read-only property
-        del schedule['users']
+        schedule['schedule_layers'] = new_layers
+        # Keep the list of users current, so that the schedule can be checked
+        # again when deleting other users
+        schedule['users'] = [u for u in schedule.get('users', [])
+                             if u.get('id') != self.user_id]
         return not_empty
 
     def remove_user_from_team(self, team_id):
@@ -275,13 +578,16 @@ class DeleteUser(RestApiV2Client):
                 return True
         return False
 
-    def put(self, url, **kw):
+    def rget(self, url, **kw):
+        return self.session.rget(url, **kw)
+
+    def rput(self, url, **kw):
         """
         Performs a put request, optionally making a backup first.
         """
         if self.backup:
             self.backup_object(url, 'updated')
-        return super(DeleteUser, self).put(url, **kw)
+        return self.session.rput(url, **kw)
 
     @property
     def user(self):
@@ -290,25 +596,66 @@ class DeleteUser(RestApiV2Client):
                                    attribute='email')
         return self._user
 
-def delete_user(user_email, args, resources):
+def remove_schedule_from_escalation_policy(user_deleter, resources, schedule,
+        ep_ref, prompt_del):
+    """
+    Removes a schedule that is about to be deleted from an escalation policy.
+
+    The escalation policy is updated if it still has rules afterwards, and
+    otherwise deleted (after prompting, if necessary).
+    """
+    # Use the cached copy (if any) so that it stays in sync for later users
+    ep = resources.get_escalation_policy(ep_ref['id'])
+    if ep is None:
+        ep = user_deleter.rget(ep_ref['self'])
+    user_deleter.remove_from_escalation_policy(ep, obj=schedule)
+    # Update the escalation policy if there are rules or delete
+    # the escalation policy if there are none
+    if len(ep['escalation_rules']) > 0:
+        try:
+            log.info("Updating escalation policy " + ep['id'])
+            user_deleter.rput(ep['self'], json=ep)
+        except Error as e:
+            handle_exception(e)
+    elif not prompt_del or input_yn((
+            "Escalation policy (ID=%s, name=%s) will be empty"
+            "after removing the schedule to be deleted. "
+            "Delete the escalation policy also?") % (ep['id'], ep['name'])):
+        try:
+            log.info("Escalation policy %s will be empty "
+                     "after removing the schedule to be deleted "
+                     "(%s). The escalation policy will also be "
+                     "deleted.", ep['id'], schedule.get('details', {}).get('id'))
+            user_deleter.rdelete(ep['self'])
+        except Exception:
+            log.warning("Escalation policy %s no longer "
+                        "has any on-call engineers or schedules but "
+                        "is still attached to services in your "
+                        "account. ", ep['id'])
+
+
+def delete_user(user_email, args, resources, report=None):
     """
     Deletes a PagerDuty user.
 
     Prompts for input when necessary to make decisions, i.e. whether to delete
     an escalation policy or schedule that will be empty after removing the user.
 
+    :param report:
+        Optional :class:`RunReport` to which the user's API calls and timing
+        are added
     :returns: integer 1 or 0 signifying whether the user was deleted
     """
 
-    access_token = args.access_token
-    from_email = args.from_email
     prompt_del = args.prompt_del
     auto_resolve = args.auto_resolve
     backup = args.backup
     no_delete = args.do_not_delete
 
     # Declare an instance of the DeleteUser class
-    user_deleter = DeleteUser(access_token, user_email, from_email, backup)
+    user_deleter = DeleteUser(resources.session, user_email, backup)
+    if report is not None:
+        report.add_user(user_deleter)
     if user_deleter.user is None:
         log.error("Unable to find user matching email %s; skipping.",
                   user_email)
@@ -326,125 +673,112 @@ def delete_user(user_email, args, resources):
     #############
     # Incidents #
     #############
-    log.info("Checking for incidents assigned to user %s...", user_id)
-    # Check for open incidents user is currently in use for
-    incidents = user_deleter.list_open_incidents()
-    n_incidents = len(incidents)
-    if n_incidents > 0:
-        # Determine if we want to auto-resolve them
-        autores = auto_resolve or input_yn("There are currently %d open "
-                                           "incidents that this user is assigned. Do you want to auto-resolve "
-                                           "them?" % n_incidents)
-        if autores:
-            log.info('Resolving all open incidents...')
-            user_deleter.resolve_incidents(incidents)
-            log.info('Successfully resolved all open incidents')
-        else:
-            log.critical("There are currently %d open incidents that this "
-                         "user is assigned. Please resolve them and try again.",
-                         n_incidents)
-            log.info("The %s%d incidents assigned to this user are: ",
-                     "first " if n_incidents > 20 else "", n_incidents)
-            for i in incidents[:20]:
-                log.info(i['self'])
-            return 0
+    with user_deleter.phase('incidents'):
+        log.info("Checking for incidents assigned to user %s...", user_id)
+        # Check for open incidents user is currently in use for
+        incidents = user_deleter.list_open_incidents()
+        n_incidents = len(incidents)
+        if n_incidents > 0:
+            # Determine if we want to auto-resolve them
+            autores = auto_resolve or input_yn("There are currently %d open "
+                                               "incidents that this user is assigned. Do you want to auto-resolve "
+                                               "them?" % n_incidents)
+            if autores:
+                log.info('Resolving all open incidents...')
+                user_deleter.resolve_incidents(incidents)
+                log.info('Successfully resolved all open incidents')
+            else:
+                log.critical("There are currently %d open incidents that this "
+                             "user is assigned. Please resolve them and try again.",
+                             n_incidents)
+                log.info("The %s%d incidents assigned to this user are: ",
+                         "first " if n_incidents > 20 else "", n_incidents)
+                for i in incidents[:20]:
+                    log.info(i['self'])
+                return 0
 
     #######################
     # Escalation Policies #
     #######################
-    log.info("Removing user %s from escalation policies...", user_id)
-    escalation_policies = user_deleter.escalation_policies
-    log.debug('Escalation policies: %s', ','.join(
-        [e['id'] for e in escalation_policies]))
-    for ep in escalation_policies:
-        # Cache escalation policy
-        user_deleter.remove_from_escalation_policy(ep)
-        # Update the escalation policy. If it's empty, ask if the user wants to
-        # delete the escalation policy
-        if len(ep['escalation_rules']) != 0 or (
-                prompt_del and not input_yn(
-            "Escalation policy ID=%s, name=%s will be empty. Delete?" % (
-                    ep['id'],
-                    ep['name']
-            )
-        )):
-            # Update the escalation policy
-            try:
-                # Delete description in case it is null
-                del (ep['description'])
-                user_deleter.rput(ep['self'], json=ep)
-            except Error as e:
-                handle_exception(e)
-        else:
-            # Attempt to delete the empty EP otherwise:
-            try:
-                log.info("Escalation policy %s is empty after removing "
-                         "the user; deleting it.", ep['id'])
-                user_deleter.rdelete(ep['self'])
-            except Exception:
-                log.warning('Could not delete escalation policy %s. It no '
-                            'longer has any on-call engineers or schedules but may '
-                            'still be in use by services in your account.',
-                            ep['name'])
-    log.info("Finished escalation policies for user %s.", user_id)
+    with user_deleter.phase('escalation_policies'):
+        log.info("Removing user %s from escalation policies...", user_id)
+        escalation_policies = resources.get_user_escalation_policies(user_id)
+        log.debug('Escalation policies: %s', ','.join(
+            [e['id'] for e in escalation_policies]))
+        for ep in escalation_policies:
+            # Other users being deleted concurrently may be on the same policy
+            with resources.lock(ep['id']):
+                # Cache escalation policy
+                user_deleter.remove_from_escalation_policy(ep)
+                # Update the escalation policy. If it's empty, ask if the user wants to
+                # delete the escalation policy
+                if len(ep['escalation_rules']) != 0 or (
+                        prompt_del and not input_yn(
+                    "Escalation policy ID=%s, name=%s will be empty. Delete?" % (
+                            ep['id'],
+                            ep['name']
+                    )
+                )):
+                    # Update the escalation policy
+                    try:
+                        # Delete description in case it is null
+                        ep.pop('description', None)
+                        user_deleter.rput(ep['self'], json=ep)
+                    except Error as e:
+                        handle_exception(e)
+                else:
+                    # Attempt to delete the empty EP otherwise:
+                    try:
+                        log.info("Escalation policy %s is empty after removing "
+                                 "the user; deleting it.", ep['id'])
+                        user_deleter.rdelete(ep['self'])
+                    except Exception:
+                        log.warning('Could not delete escalation policy %s. It no '
+                                    'longer has any on-call engineers or schedules but may '
+                                    'still be in use by services in your account.',
+                                    ep['name'])
+        log.info("Finished escalation policies for user %s.", user_id)
 
     #############
     # Schedules #
     #############
-    log.info("Removing user %s from schedules...", user_id)
-
-    for schedule in resources.get_schedules():
-        # Check if user is in schedule
-        if user_deleter.schedule_has_user(schedule.get('details')):
-            non_empty = user_deleter.remove_from_schedule(schedule.get('details'))
-            # If deleting, remove the schedule from any escalation policies
-            if not non_empty and (prompt_del and input_yn(
-                    ("Schedule (ID=%s, name=%s) will be empty after removing "
-                     "user. Delete it?") % (schedule.get('details', {}).get('id'), schedule.get('details', {}).get('name'))
-            )):
-                for ep_ref in schedule.get('details', {}).get('escalation_policies'):
-                    # Remove schedule from escalation policies...
-                    ep = user_deleter.rget(ep_ref['self'])
-                    user_deleter.remove_from_escalation_policy(ep, obj=schedule)
-                    # Update the escalation policy if there are rules or delete
-                    # the escalation policy if there are none
-                    if len(ep['escalation_rules']) > 0:
-                        try:
-                            log.info("Updating escalation policy " + ep['id'])
-                            user_deleter.rput(ep['self'], json=ep)
-                        except Error as e:
-                            handle_exception(e)
-                    elif not prompt_del or input_yn((
-                                                            "Escalation policy (ID=%s, name=%s) will be empty"
-                                                            "after removing the schedule to be deleted. "
-                                                            "Delete the escalation policy also?") % (
-                                                            ep['id'], ep['name'])):
-                        try:
-                            log.info("Escalation policy %s will be empty "
-                                     "after removing the schedule to be deleted "
-                                     "(%s). The escalation policy will also be "
-                                     "deleted.", ep['id'], schedule.get('details', {}).get('id'))
-                            user_deleter.rdelete(ep['self'])
-                        except Exception:
-                            log.warning("Escalation policy %s no longer "
-                                        "has any on-call engineers or schedules but "
-                                        "is still attached to services in your "
-                                        "account. ", ep['id'])
-                user_deleter.rdelete(schedule.get('details', {}).get('self'))
-            else:
-                # Save updated schedule with user removed
-                user_deleter.rput(schedule.get('details', {}).get('self'), json=schedule.get('details'))
-    log.info("Finished schedules for user %s.", user_id)
+    with user_deleter.phase('schedules'):
+        log.info("Removing user %s from schedules...", user_id)
+
+        for schedule in resources.get_schedules():
+            details = schedule.get('details', {})
+            # Lock order is always schedule, then escalation policy
+            with resources.lock(details.get('id')):
+                # Check if user is in schedule
+                if not user_deleter.schedule_has_user(details):
+                    continue
+                non_empty = user_deleter.remove_from_schedule(details)
+                # If deleting, remove the schedule from any escalation policies
+                if not non_empty and (prompt_del and input_yn(
+                        ("Schedule (ID=%s, name=%s) will be empty after removing "
+                         "user. Delete it?") % (details.get('id'), details.get('name'))
+                )):
+                    for ep_ref in details.get('escalation_policies'):
+                        with resources.lock(ep_ref['id']):
+                            remove_schedule_from_escalation_policy(user_deleter,
+                                resources, schedule, ep_ref, prompt_del)
+                    user_deleter.rdelete(details.get('self'))
+                else:
+                    # Save updated schedule with user removed
+                    user_deleter.rput(details.get('self'), json=schedule_payload(details))
+        log.info("Finished schedules for user %s.", user_id)
 
     #########
     # Teams #
     #########
-    log.info("Removing user %s from teams...", user_id)
+    with user_deleter.phase('teams'):
+        log.info("Removing user %s from teams...", user_id)
 
-    for team in resources.get_teams():
-        if user_deleter.team_has_user(team['users']):
-            user_deleter.remove_user_from_team(team['id'])
-    log.info("Finished teams for user %s.", user_id)
+        for team in resources.get_teams():
+            if user_deleter.team_has_user(team['users']):
+                with resources.lock(team['id']):
+                    user_deleter.remove_user_from_team(team['id'])
+        log.info("Finished teams for user %s.", user_id)
 
     ##################
     # Sayonara, User #
@@ -461,7 +795,9 @@ def delete_user(user_email, args, resources):
     if no_delete:
         log.info('User %s was not deleted; "Do not delete user" flag selected.', user_email)
         return 0
-    elif user_deleter.delete_user():
+    with user_deleter.phase('delete'):
+        deleted = user_deleter.delete_user()
+    if deleted:
         log.info('User %s has been successfully deleted!', user_email)
         return 1
     else:
@@ -469,6 +805,89 @@ def delete_user(user_email, args, resources):
         return 0
 
 
+def try_delete_user(user_email, args, resources, report=None):
+    """
+    Deletes a PagerDuty user as in :func:`delete_user`, but logs any error and
+    counts the user as not deleted, so that it doesn't stop the others.
+    """
+    try:
+        return delete_user(user_email, args, resources, report)
+    except Exception as e:
+        if isinstance(e, Error):
+            handle_exception(e)
+        else:
+            log.exception(e)
+        log.error('User %s not removed; error: %s', user_email, e)
+        if report is not None:
+            report.add_failure(user_email, e)
+        return 0
+
+
+def simulate(email_list, resources):
+    """
+    Reports the impact of deprovisioning users without making any changes.
+
+    The account is loaded once, and then each user is removed from in-memory
+    copies of the schedules and escalation policies. Only GET requests are made.
+    """
+    users_by_email = resources.get_users_by_email()
+    # Nothing is changed, so the details can be retrieved several at a time
+    schedules = copy.deepcopy([s['details'] for s in resources.get_schedules(
+        workers=SIMULATE_DETAIL_WORKERS)])
+    escalation_policies = copy.deepcopy(resources.get_escalation_policies())
+    services = resources.get_services()
+    escalation_policies_by_id = dict([(ep['id'], ep) for ep in escalation_policies])
+    escalation_policies_by_user = index_escalation_policies_by_user(
+        escalation_policies)
+
+    not_found = []
+    empty_schedules = {}
+    empty_escalation_policies = {}
+    for email in email_list:
+        user = users_by_email.get(email.lower())
+        if user is None:
+            not_found.append(email)
+            continue
+        user_deleter = DeleteUser(resources.session, email, False, user=user)
+        for ep in escalation_policies_by_user.get(user['id'], []):
+            if not user_deleter.remove_from_escalation_policy(ep):
+                empty_escalation_policies[ep['id']] = ep
+        for schedule in schedules:
+            if user_deleter.schedule_has_user(schedule) and \
+                    not user_deleter.remove_from_schedule(schedule):
+                empty_schedules[schedule['id']] = schedule
+
+    # Escalation policies that would then be empty if the empty schedules were
+    # also deleted (i.e. when answering yes to the prompt to delete them). The
+    # object to remove is given, so it doesn't matter which user this is for.
+    for schedule in empty_schedules.values():
+        for ep_ref in schedule.get('escalation_policies', []):
+            ep = escalation_policies_by_id.get(ep_ref['id'])
+            if ep is not None and not user_deleter.remove_from_escalation_policy(
+                    ep, obj=schedule):
+                empty_escalation_policies[ep['id']] = ep
+
+    affected_services = [s for s in services
+        if s.get('escalation_policy', {}).get('id') in empty_escalation_policies]
+
+    print("\nIMPACT OF DEPROVISIONING %d USER(S) (no changes were made)" % len(email_list))
+    print("Users not found: %d" % len(not_found))
+    for email in not_found:
+        print("  - %s" % email)
+    print("Schedules that will have no users on any layer: %d" % len(empty_schedules))
+    for schedule in empty_schedules.values():
+        print("  - %s (%s)" % (schedule['id'], schedule['name']))
+    print("Escalation policies that will lose all of their rules (if empty "
+          "schedules are also deleted): %d" % len(empty_escalation_policies))
+    for ep in empty_escalation_policies.values():
+        print("  - %s (%s)" % (ep['id'], ep['name']))
+    print("Services that would be left on an empty escalation policy: %d" % len(affected_services))
+    for service in affected_services:
+        print("  - %s (%s), escalation policy %s" % (service['id'],
+              service['name'], service['escalation_policy']['id']))
+    print("")
+
+
 def setup_logging(is_log_verbose):
     # Initialize logging:
     logdir = os.path.join(os.getcwd(), 'logs')
@@ -502,28 +921,62 @@ def main(arguments):
                 continue
             email_list.append(email)
 
-    if arguments.do_not_delete is True:
-        print("{} users to be removed from schedules, teams, and escalation policies. Users will not be deleted."
-        .format(len(email_list)))
-    else:
-        print("{} users to be deleted".format(len(email_list)))
+    # With --simulate, nothing is changed; simulate() reports the impact
+    if not arguments.simulate:
+        if arguments.do_not_delete is True:
+            print("{} users to be removed from schedules, teams, and escalation policies. Users will not be deleted."
+            .format(len(email_list)))
+        else:
+            print("{} users to be deleted".format(len(email_list)))
 
     # Initialize logging:
     setup_logging(arguments.verbose)
 
+    if arguments.simulate:
+        simulate(email_list, resources)
+        print("Script complete.\n")
+        return
+
+    # Load everything shared between users before starting, so that it isn't
+    # fetched by several threads at once or counted against the first user
+    report = RunReport(arguments.workers)
+    resources.session.recorder = report
+    with report.phase('prefetch'):
+        resources.get_escalation_policies()
+        resources.get_schedules()
+        resources.get_teams()
+
     # Do the deed:
     count = 0
-    for email in email_list:
-        if arguments.prompt_del and arguments.do_not_delete:
-            if not input_yn("Proceed with removal of user (%s) from all associated resources?" % email):
+    if arguments.workers > 1:
+        if arguments.backup and not os.path.isdir('backup'):
+            os.mkdir('backup')
+        with ThreadPoolExecutor(max_workers=arguments.workers) as executor:
+            count = sum(executor.map(
+                lambda email: try_delete_user(email, arguments, resources, report),
+                email_list
+            ))
+    else:
+        for email in email_list:
+            if arguments.prompt_del and arguments.do_not_delete:
+                if not input_yn("Proceed with removal of user (%s) from all associated resources?" % email):
+                    continue
+            elif arguments.prompt_del and not input_yn("Proceed with deletion of user (%s)?" % email):
                 continue
-        elif arguments.prompt_del and not input_yn("Proceed with deletion of user (%s)?" % email):
-            continue
-        count += delete_user(email, arguments, resources)
+            count += try_delete_user(email, arguments, resources, report)
 
     log.info("%d user(s) out of %d specified have been deleted." % (
         count, len(email_list)
     ))
+    if report.failures:
+        log.error("%d user(s) could not be deprovisioned due to errors: %s",
+                  len(report.failures),
+                  ', '.join([f['email'] for f in report.failures]))
+    log.info("%d API calls made in total.",
+             sum(resources.session.api_call_counts.values()))
+    if arguments.report_file:
+        report.write(arguments.report_file)
+        log.info("Run report saved to %s", arguments.report_file)
 
     print("Script complete.\n")
 
@@ -574,10 +1027,37 @@ if __name__ == '__main__':
         help="Do not delete user but perform all other actions",
         dest='do_not_delete', action='store_true', default=False
     )
+    parser.add_argument(
+        '--simulate', '-s',
+        help="Do not make any changes; instead, load the account once and "
+             "report which schedules, escalation policies and services would "
+             "be left empty or without on-call responders after removing the "
+             "users.",
+        default=False, action='store_true'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        help="Number of users to deprovision at once. Values greater than 1 "
+             "require --delete-yes-to-all and --auto-resolve-incidents, since "
+             "there can be no prompting.",
+        dest='workers', type=int, default=1
+    )
+    parser.add_argument(
+        '--report-file',
+        help="Write a JSON report to this file of the time taken and API "
+             "calls made (GET/PUT/DELETE and retries) for each user and each "
+             "phase of deprovisioning, along with run-wide totals.",
+        dest='report_file', default=None
+    )
     parser.add_argument(
         '--verbose', '-v',
         help="Verbose command line output (show progress)",
         default=False, action='store_true'
     )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and (args.prompt_del or not args.auto_resolve):
+        parser.error("--workers greater than 1 requires --delete-yes-to-all "
+                     "(-y) and --auto-resolve-incidents (-r)")
     main(args)